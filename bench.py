@@ -0,0 +1,427 @@
+"""Banc de test hors ligne du bot : Gemini, ElevenLabs et le vocal Discord sont simulés.
+
+Le bot est piloté comme en production (commande !chaos, sessions par serveur, buffer,
+pool de clés) mais les fournisseurs sont remplacés par des doublures à latence réglable.
+Le résultat est un JSON (baseline) comparable d'une version à l'autre.
+
+    python bench.py --guilds 4 --rate 6 --duration 60 --output baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import dotenv
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaamelott.mp3")
+
+# Vocabulaire des textes simulés : assez large pour que deux textes ne soient pas des quasi-doublons
+WORDS = """chaussette ministre lampadaire cosmique baguette fromage pigeon révolution
+quantique escargot tracteur philosophie banane volcan grand-mère trombone galaxie
+parapluie dinosaure sardine manifeste cathédrale hamster bureaucratie moustache
+satellite croissant licorne aspirateur prophétie concombre mairie tuba horloge
+camembert neutrino brouette sorcier autoroute poireau conspiration marmotte orchestre
+radiateur dragon facture chandelier pingouin cadastre trottinette oracle saucisson
+plombier nébuleuse tartiflette guillotine kangourou formulaire comète accordéon""".split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne du bot chaos")
+    parser.add_argument("--guilds", type=int, default=4, help="Serveurs simulés")
+    parser.add_argument("--rate", type=float, default=6.0, help="!chaos par minute et par serveur")
+    parser.add_argument("--duration", type=float, default=60.0, help="Durée du trafic (secondes)")
+    parser.add_argument("--keys", type=int, default=2, help="Clés ElevenLabs simulées")
+    parser.add_argument("--key-quota", type=int, default=100000, help="Caractères disponibles par clé")
+    parser.add_argument("--gemini-latency", type=float, default=2.0, help="Latence moyenne d'une requête Gemini (s)")
+    parser.add_argument("--tts-first-chunk", type=float, default=0.4, help="Latence du premier chunk ElevenLabs (s)")
+    parser.add_argument("--tts-chunk-delay", type=float, default=0.02, help="Délai entre deux chunks ElevenLabs (s)")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="Taille des chunks MP3 simulés (octets)")
+    parser.add_argument("--speech-rate", type=float, default=15.0, help="Caractères lus par seconde d'audio simulé")
+    parser.add_argument("--voice-latency", type=float, default=0.5, help="Durée d'une nouvelle connexion vocale (s)")
+    parser.add_argument("--playback-scale", type=float, default=0.1, help="Facteur appliqué aux durées de lecture")
+    parser.add_argument("--queue-depth", type=int, help="!chaos en attente au maximum par canal (défaut : celui du bot)")
+    parser.add_argument("--coalesce-window", type=float, help="Fenêtre de regroupement des doublons en secondes (défaut : celle du bot)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilité d'erreur 5xx par requête fournisseur")
+    parser.add_argument("--fixture", default=FIXTURE, help="MP3 renvoyé par le faux ElevenLabs")
+    parser.add_argument("--seed", type=int, default=1, help="Graine du générateur de trafic")
+    parser.add_argument("--output", help="Fichier JSON de sortie (stdout par défaut)")
+    parser.add_argument("--verbose", action="store_true", help="Afficher les logs du bot")
+    return parser.parse_args()
+
+
+def jitter(latency):
+    """Latence simulée : ±50 % autour de la moyenne"""
+    return latency * random.uniform(0.5, 1.5)
+
+
+# ===== DOUBLURES DES FOURNISSEURS =====
+
+class FakeProviders:
+    """Remplace HTTPProviders : mêmes méthodes, réponses locales"""
+
+    def __init__(self, args, app, audio):
+        self.args = args
+        self.app = app
+        # Trames audio de la fixture, répétées pour obtenir une durée proportionnelle au texte
+        self.frames = [(audio[pos:pos + length], duration) for pos, length, duration in app.mp3_frames(audio)]
+        self.gemini_requests = 0
+        self.tts_requests = 0
+        self.usage = {}  # {api_key: caractères consommés}
+
+    def _maybe_fail(self, provider):
+        if random.random() < self.args.error_rate:
+            raise self.app.ProviderError(provider, 503, "erreur simulée")
+
+    def _fake_text(self):
+        # Longueur des vrais textes : 3 à 4 phrases courtes, environ 200 à 430 caractères
+        words = random.sample(WORDS, random.randint(20, 40))
+        count = random.randint(3, 4)
+        size = -(-len(words) // count)
+        sentences = [" ".join(words[i:i + size]).capitalize() + "." for i in range(0, len(words), size)]
+        return "Vive le chaos ! " + " ".join(sentences)
+
+    async def gemini_generate(self, prompt, generation_config=None):
+        self.gemini_requests += 1
+        await asyncio.sleep(jitter(self.args.gemini_latency))
+        self._maybe_fail("Gemini")
+        if generation_config and generation_config.get("responseMimeType") == "application/json":
+            match = re.search(r"Génère (\d+) paragraphes", prompt)
+            count = int(match.group(1)) if match else 1
+            return json.dumps([self._fake_text() for _ in range(count)], ensure_ascii=False)
+        return self._fake_text()
+
+    async def elevenlabs_stream(self, api_key, text, previous_text=None, next_text=None, settings=None):
+        self.tts_requests += 1
+        used = self.usage.get(api_key, 0)
+        if used + len(text) > self.args.key_quota:
+            raise self.app.ProviderError("ElevenLabs", 401, "quota_exceeded")
+        await asyncio.sleep(jitter(self.args.tts_first_chunk))
+        self._maybe_fail("ElevenLabs")
+        self.usage[api_key] = used + len(text)
+        audio = self._fake_audio(len(text) / self.args.speech_rate)
+        for offset in range(0, len(audio), self.args.chunk_size):
+            yield audio[offset:offset + self.args.chunk_size]
+            await asyncio.sleep(self.args.tts_chunk_delay)
+
+    def _fake_audio(self, seconds):
+        frames = []
+        total = 0.0
+        while total < seconds:
+            frame, duration = self.frames[len(frames) % len(self.frames)]
+            frames.append(frame)
+            total += duration
+        return b"".join(frames)
+
+    async def warmup(self):
+        pass
+
+    async def elevenlabs_subscription(self, api_key):
+        return {
+            "character_limit": self.args.key_quota,
+            "character_count": self.usage.get(api_key, 0),
+            "next_character_count_reset_unix": int(time.time()) + 86400,
+        }
+
+    async def close(self):
+        pass
+
+
+class FakePCMAudio:
+    """Remplace discord.FFmpegPCMAudio (pas de FFmpeg) : garde la source pour le faux vocal"""
+
+    def __init__(self, source, *, pipe=False, **kwargs):
+        self.source = source
+        self.pipe = pipe
+
+    def read_all(self):
+        if not self.pipe:
+            with open(self.source, "rb") as f:
+                return f.read()
+        chunks = []
+        while True:
+            chunk = self.source.read(65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """Connexion vocale simulée : la lecture dure la durée du MP3 × playback_scale"""
+
+    def __init__(self, app, channel, scale):
+        self.app = app
+        self.channel = channel
+        self.guild = channel.guild
+        self.scale = scale
+        self.connected = True
+        self.playing = None  # threading.Event de la lecture en cours
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing is not None and not self.playing.is_set()
+
+    def play(self, source, *, after=None):
+        stopped = threading.Event()
+        self.playing = stopped
+
+        def run():
+            # Comme le lecteur de discord.py : thread dédié, after() appelé depuis ce thread
+            if isinstance(source, FakePCMAudio):
+                duration = self.app.mp3_duration(source.read_all()) or 0
+            else:
+                # Sources en mémoire du bot (MemoryPCMAudio, OpusPacketAudio) : durée connue
+                duration = source.duration
+            stopped.wait(duration * self.scale)
+            stopped.set()
+            if after:
+                after(None)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        if self.playing:
+            self.playing.set()
+
+    async def move_to(self, channel):
+        await asyncio.sleep(jitter(self.channel.latency) / 4)
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self.connected = False
+        self.app.bot._connection._remove_voice_client(self.guild.id)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"bench-{guild_id}"
+
+
+class FakeChannel:
+    def __init__(self, app, guild, latency, scale):
+        self.app = app
+        self.guild = guild
+        self.latency = latency
+        self.scale = scale
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(jitter(self.latency))
+        voice_client = FakeVoiceClient(self.app, self, self.scale)
+        self.app.bot._connection._add_voice_client(self.guild.id, voice_client)
+        return voice_client
+
+
+class FakeContext:
+    """Contexte de commande minimal : auteur dans un canal vocal, messages ignorés"""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.author = type("Author", (), {"voice": type("Voice", (), {"channel": channel})()})()
+        self.messages = 0
+
+    async def send(self, content):
+        self.messages += 1
+
+
+# ===== MESURES =====
+
+class LoopLagMonitor:
+    """Mesure le retard de la boucle asyncio (réveils en retard = boucle bloquée)"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        self.task.cancel()
+
+
+def summarize(samples):
+    """p50/p95/p99/max d'une série de mesures (secondes)"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def percentile(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 4),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def histogram_samples(app, name, **labels):
+    histogram = app.metrics.get(name, **labels)
+    return list(histogram.samples) if histogram else []
+
+
+# ===== SCÉNARIO =====
+
+async def run_bench(app, args):
+    fake = FakeProviders(args, app, open(args.fixture, "rb").read())
+    app.providers = fake
+    app.discord.FFmpegPCMAudio = FakePCMAudio
+    if args.queue_depth is not None:
+        app.scheduler.max_depth = args.queue_depth
+    if args.coalesce_window is not None:
+        app.scheduler.coalesce_window = args.coalesce_window
+
+    lag = LoopLagMonitor()
+    lag.start()
+
+    # 1. Démarrage à froid (même séquence que setup_hook) et remplissage initial
+    app.startup = app.StartupState()
+    started = time.perf_counter()
+    warm_start = asyncio.create_task(app.warm_start())
+    while not (app.buffer_pipeline.workers and app.buffer_pipeline.idle.is_set()):
+        await asyncio.sleep(0.05)
+    initial_fill = time.perf_counter() - started
+    initial_entries = app.buffered_count()
+    await warm_start
+
+    # 2. Trafic multi-serveurs : arrivées de Poisson indépendantes par serveur
+    added_before = app.metrics.counter("buffer_entries_total", result="added")
+    commands = []
+
+    async def guild_traffic(guild_id):
+        guild = FakeGuild(guild_id)
+        channel = FakeChannel(app, guild, args.voice_latency, args.playback_scale)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + args.duration
+        while True:
+            gap = random.expovariate(args.rate / 60)
+            if loop.time() + gap >= deadline:
+                return
+            await asyncio.sleep(gap)
+            commands.append(asyncio.create_task(app.chaos.callback(FakeContext(guild, channel))))
+
+    traffic_started = time.perf_counter()
+    await asyncio.gather(*(guild_traffic(1000 + i) for i in range(args.guilds)))
+    results = await asyncio.gather(*commands, return_exceptions=True)
+    elapsed = time.perf_counter() - traffic_started
+    added = app.metrics.counter("buffer_entries_total", result="added") - added_before
+
+    lag.stop()
+    app.refill_task.cancel()
+    for worker in app.buffer_pipeline.workers:
+        worker.cancel()
+    for task in list(app.voice_pool.idle_tasks.values()):
+        task.cancel()
+
+    hits = app.metrics.counter("chaos_commands_total", path="buffer")
+    misses = app.metrics.counter("chaos_commands_total", path="fallback")
+    return {
+        "config": vars(args),
+        "commands": {
+            "issued": len(commands),
+            "completed": hits + misses,
+            "coalesced": app.metrics.counter("chaos_requests_total", result="coalesced"),
+            "rejected": app.metrics.counter("chaos_requests_total", result="rejected"),
+            "errors": sum(1 for result in results if isinstance(result, BaseException)),
+            "buffer_hits": hits,
+            "buffer_misses": misses,
+            "buffer_hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+        },
+        "time_to_first_audio": {
+            "all": summarize(histogram_samples(app, "chaos_time_to_first_audio_seconds", path="buffer")
+                             + histogram_samples(app, "chaos_time_to_first_audio_seconds", path="fallback")),
+            "buffer": summarize(histogram_samples(app, "chaos_time_to_first_audio_seconds", path="buffer")),
+            "fallback": summarize(histogram_samples(app, "chaos_time_to_first_audio_seconds", path="fallback")),
+        },
+        "time_to_speech": {
+            "buffer": summarize(histogram_samples(app, "chaos_time_to_speech_seconds", path="buffer")),
+            "fallback": summarize(histogram_samples(app, "chaos_time_to_speech_seconds", path="fallback")),
+        },
+        "startup": {name: round(seconds, 3) for name, seconds in app.startup.milestones.items()},
+        "refill": {
+            "initial_fill_seconds": round(initial_fill, 3),
+            "initial_entries": initial_entries,
+            "entries_added": added,
+            "entries_per_minute": round(added / elapsed * 60, 2) if elapsed else None,
+            "entry_latency": summarize(histogram_samples(app, "buffer_entry_seconds")),
+            "final_target": app.buffer_target(),
+            "final_entries": app.buffered_count(),
+        },
+        "providers": {
+            "gemini_requests": fake.gemini_requests,
+            "tts_requests": fake.tts_requests,
+            "characters": sum(fake.usage.values()),
+        },
+        "loop_lag": summarize(lag.samples),
+        "duration_seconds": round(elapsed, 3),
+    }
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+
+    # Répertoire de travail jetable : spool, cache et historique ne touchent pas ceux du bot
+    workdir = tempfile.mkdtemp(prefix="chaos-bench-")
+    shutil.copy(FIXTURE, os.path.join(workdir, "kaamelott.mp3"))
+    os.environ["DISCORD_TOKEN"] = "bench"
+    os.environ["GEMINI_API_KEY"] = "bench"
+    for i in range(4):
+        name = "ELEVENLABS_API_KEY" if i == 0 else f"ELEVENLABS_API_KEY_{i + 1}"
+        if i < args.keys:
+            os.environ[name] = f"bench-key-{i + 1}"
+        else:
+            os.environ.pop(name, None)
+    # Le .env du développeur ne doit pas fausser la mesure (clés en plus, BUFFER_*, SHARED_STORE_PATH...) :
+    # seules comptent les variables ci-dessus et celles passées explicitement dans l'environnement
+    dotenv.load_dotenv = lambda *args, **kwargs: False
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    logs = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else logs):
+            import chaos as app
+            report = asyncio.run(run_bench(app, args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"📊 Baseline écrite dans {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
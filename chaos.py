@@ -1,15 +1,31 @@
 import discord
 from discord.ext import commands
-from google import genai
+import aiohttp
+import aiohttp.web
 import os
 from dotenv import load_dotenv
 from collections import deque
 import asyncio
-from elevenlabs.client import ElevenLabs
-from elevenlabs import VoiceSettings
 import tempfile
 import subprocess
+import sys
+import traceback
 import json
+import hashlib
+import math
+import re
+import random
+import io
+import struct
+import queue
+import threading
+import time
+import weakref
+import itertools
+import sqlite3
+import socket
+from collections import OrderedDict, Counter
+from contextlib import contextmanager, nullcontext
 
 # Charger les variables d'environnement
 load_dotenv()
@@ -18,7 +34,269 @@ load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
-# ===== SYSTÈME DE ROTATION DES CLÉS ELEVENLABS =====
+# ===== TÂCHES DE FOND =====
+background_tasks = set()  # Références gardées : la boucle ne garde que des références faibles
+
+
+def spawn(coro):
+    """Lance une tâche de fond sans l'attendre : référence gardée jusqu'à sa fin, erreur journalisée"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        error = task.exception()
+        print(f"❌ Tâche de fond: {type(error).__name__}: {error}")
+
+
+# ===== MÉTRIQUES =====
+# Histogrammes et compteurs en mémoire, visibles via !stats et, si METRICS_PORT
+# est défini, via un endpoint local au format Prometheus.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 = pas d'endpoint HTTP
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120)
+METRICS_SAMPLES = 2000  # Dernières mesures gardées pour les percentiles de !stats
+
+
+class Histogram:
+    """Histogramme cumulatif (format Prometheus) + échantillon récent pour les percentiles"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=METRICS_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Metrics:
+    """Registre des métriques du bot"""
+
+    def __init__(self):
+        self.histograms = {}  # {(nom, labels): Histogram}
+        self.counters = {}  # {(nom, labels): valeur}
+        self.gauges = {}  # {nom: fonction qui retourne la valeur}
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, getter, help_text=""):
+        self.gauges[name] = getter
+        self.help[name] = help_text
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Mesure la durée d'un bloc (synchrone ou contenant des await)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def get(self, name, **labels):
+        return self.histograms.get(self._key(name, labels))
+
+    def counter(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render_prometheus(self):
+        """Exporte toutes les métriques au format texte Prometheus"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(METRICS_BUCKETS, histogram.bucket_counts):
+                lines.append(f"{name}_bucket{self._labels(labels, ('le', bound))} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, ('le', '+Inf'))} {histogram.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, getter in sorted(self.gauges.items()):
+            try:
+                value = getter()
+            except Exception:
+                continue
+            if self.help.get(name):
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics_runner = None  # Serveur HTTP /metrics (si METRICS_PORT)
+
+
+async def start_metrics_server():
+    """Lance l'endpoint /metrics local (si METRICS_PORT est défini)"""
+    if not METRICS_PORT:
+        return None
+
+    async def handle_metrics(request):
+        return aiohttp.web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Métriques Prometheus sur http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+# ===== SURVEILLANCE DE LA BOUCLE (RETARD ET APPELS BLOQUANTS) =====
+# Un battement sur la boucle mesure son retard en continu ; un thread à part capture
+# la pile du code qui bloque la boucle au-delà du seuil (visible via !lag).
+LOOP_WATCHDOG_THRESHOLD = float(os.getenv('LOOP_WATCHDOG_THRESHOLD_MS', '100')) / 1000  # 0 = désactivé
+LOOP_WATCHDOG_INTERVAL = 0.05  # Période du battement
+LOOP_WATCHDOG_DUMP = os.getenv('LOOP_WATCHDOG_DUMP', 'loop_stalls.json')
+LOOP_WATCHDOG_RECENT = 50  # Derniers blocages gardés avec leur pile complète
+
+
+class LoopWatchdog:
+    """Détecteur de blocages de la boucle asyncio, avec compteurs par site (fichier:ligne fonction)"""
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self.beat = time.monotonic()
+        self.loop_thread = None
+        self.pending = None  # Pile capturée pendant le blocage en cours
+        self.sites = {}  # {site: {"count", "seconds", "max"}}
+        self.recent = deque(maxlen=LOOP_WATCHDOG_RECENT)
+        self.stalls = 0
+        self.lock = threading.Lock()
+        self.task = None
+
+    def start(self):
+        """À appeler depuis la boucle à surveiller (une seule fois)"""
+        if self.task is not None or self.threshold <= 0:
+            return
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        print(f"🐢 Surveillance de la boucle activée (seuil {self.threshold * 1000:.0f} ms)")
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            metrics.observe("event_loop_lag_seconds", lag)
+            with self.lock:
+                self.beat = now
+                stack, self.pending = self.pending, None
+            if stack is not None:
+                self._record(stack, lag)
+
+    def _watch(self):
+        """Thread : si le battement tarde, capture la pile du thread de la boucle"""
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.pending is not None or time.monotonic() - self.beat < self.interval + self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.pending = traceback.extract_stack(frame)
+
+    @staticmethod
+    def _site(stack):
+        """Ligne de notre code la plus profonde dans la pile, suivie de l'appel bloquant s'il est ailleurs"""
+        innermost = stack[-1]
+        own = next((f for f in reversed(stack) if f.filename == __file__), innermost)
+        site = f"{os.path.basename(own.filename)}:{own.lineno} {own.name}"
+        if own is not innermost:
+            site += f" → {os.path.basename(innermost.filename)}:{innermost.lineno} {innermost.name}"
+        return site
+
+    def _record(self, stack, lag):
+        site = self._site(stack)
+        stats = self.sites.setdefault(site, {"count": 0, "seconds": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["seconds"] += lag
+        stats["max"] = max(stats["max"], lag)
+        self.stalls += 1
+        self.recent.append({
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds": round(lag, 3),
+            "site": site,
+            "stack": traceback.format_list(stack),
+        })
+        metrics.inc("event_loop_stalls_total")
+        print(f"🐢 Boucle bloquée {lag * 1000:.0f} ms : {site}")
+
+    def top_sites(self, limit=5):
+        """Sites les plus coûteux (temps bloqué cumulé)"""
+        return sorted(self.sites.items(), key=lambda item: item[1]["seconds"], reverse=True)[:limit]
+
+    def snapshot(self):
+        """Copie des compteurs, prise sur la boucle (_record les modifie pendant l'écriture)"""
+        return {
+            "threshold_seconds": self.threshold,
+            "stalls": self.stalls,
+            "sites": {site: dict(stats) for site, stats in self.sites.items()},
+            "recent": list(self.recent),
+        }
+
+    @staticmethod
+    def dump_sync(path, report):
+        """Écrit un snapshot (compteurs et derniers blocages avec piles) de façon atomique"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_THRESHOLD, LOOP_WATCHDOG_INTERVAL)
+
+
+# ===== POOL DE CLÉS ELEVENLABS =====
 ELEVENLABS_API_KEYS = [
     os.getenv('ELEVENLABS_API_KEY'),
     os.getenv('ELEVENLABS_API_KEY_2'),
@@ -27,136 +305,1535 @@ ELEVENLABS_API_KEYS = [
 ]
 # Filtrer les clés None ou vides
 ELEVENLABS_API_KEYS = [k for k in ELEVENLABS_API_KEYS if k]
-current_elevenlabs_key_index = 0
+# Appels simultanés autorisés par clé (limite de concurrence du plan ElevenLabs)
+ELEVENLABS_MAX_CONCURRENCY_PER_KEY = int(os.getenv('ELEVENLABS_MAX_CONCURRENCY_PER_KEY', '2'))
+# Pause d'une clé épuisée quand l'API ne donne pas la date de remise à zéro
+ELEVENLABS_KEY_COOLDOWN = float(os.getenv('ELEVENLABS_KEY_COOLDOWN', '3600'))
+# Pause courte après une erreur transitoire (rate limit, 5xx...)
+ELEVENLABS_ERROR_COOLDOWN = 30
 
-# Initialiser le client Gemini (nouvelle API)
-gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+# ===== SHARDING (PLUSIEURS PROCESSUS) =====
+# Shards gérés par ce processus, ex. SHARD_IDS=0,1 et SHARD_COUNT=4 (vide = automatique)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(s) for s in os.getenv('SHARD_IDS', '').split(',') if s.strip()] or None
+if SHARD_IDS and (not SHARD_COUNT or any(not 0 <= shard_id < SHARD_COUNT for shard_id in SHARD_IDS)):
+    raise SystemExit(f"❌ SHARD_IDS={os.getenv('SHARD_IDS')} nécessite SHARD_COUNT et des IDs entre 0 et SHARD_COUNT-1 "
+                     f"(SHARD_COUNT={SHARD_COUNT or 'absent'})")
+# Base SQLite commune aux processus d'une même machine (vide = buffer propre à ce processus)
+SHARED_STORE_PATH = os.getenv('SHARED_STORE_PATH', '')
+SHARED_POLL_INTERVAL = float(os.getenv('SHARED_POLL_INTERVAL', '1'))  # Détection des écritures des autres processus
+GENERATOR_LEASE_TTL = 15  # Bail du processus générateur, renouvelé tous les tiers
+KEY_SYNC_INTERVAL = 2  # Relecture de l'état des clés publié par les autres processus
+SPOOL_ORPHAN_AGE = 600  # Mode partagé : fichier sans ligne épargné ce temps-là (écriture en cours)
+SPOOL_PLAYING_TTL = 3600  # Mode partagé : fichier pioché protégé du GC pendant sa lecture
+# Rôle du processus : all (Discord + génération), gateway (Discord seul : dispatch et lecture)
+# ou worker (génération seule, sans connexion Discord). gateway/worker passent par le store partagé.
+CHAOS_ROLE = os.getenv('CHAOS_ROLE', 'all')
+if CHAOS_ROLE not in ("all", "gateway", "worker") or (CHAOS_ROLE != "all" and not SHARED_STORE_PATH):
+    raise SystemExit("❌ CHAOS_ROLE doit valoir all, gateway ou worker (gateway et worker nécessitent SHARED_STORE_PATH)")
+PRODUCER_TTL = 300  # Entrées en cours d'un producteur ignorées s'il ne donne plus signe de vie
 
-# Initialiser ElevenLabs avec la première clé
-elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEYS[0]) if ELEVENLABS_API_KEYS else None
+# ===== FOURNISSEURS HTTP (GEMINI / ELEVENLABS) =====
+# Appels natifs asyncio sur un pool de connexions keep-alive partagé :
+# ni thread de l'executor ni nouveau handshake TLS à chaque requête.
+GEMINI_MODEL = "gemini-3-pro-preview"
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta"
+ELEVENLABS_API_URL = "https://api.elevenlabs.io/v1"
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))  # Connexions simultanées max
+HTTP_KEEPALIVE = 60  # Secondes pendant lesquelles une connexion inactive est gardée
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '4'))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '90'))
+ELEVENLABS_TIMEOUT = float(os.getenv('ELEVENLABS_TIMEOUT', '60'))
+
+
+class ProviderError(Exception):
+    """Erreur renvoyée par l'API d'un fournisseur"""
+
+    def __init__(self, provider, status, message):
+        super().__init__(f"{provider} HTTP {status}: {message}")
+        self.provider = provider
+        self.status = status
+
+
+class HTTPProviders:
+    """Clients asynchrones Gemini et ElevenLabs sur une session aiohttp partagée"""
+
+    def __init__(self):
+        self.session = None
+        self.gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+    def get_session(self):
+        """Session HTTP partagée (créée au premier usage, dans la boucle du bot)"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+    @staticmethod
+    async def _raise_for_status(provider, response):
+        if response.status >= 400:
+            metrics.inc("provider_errors_total", provider=provider.lower(), status=response.status)
+            body = await response.text()
+            raise ProviderError(provider, response.status, body[:500])
+
+    async def gemini_generate(self, prompt, generation_config=None):
+        """Génère du texte avec Gemini (API REST generateContent)"""
+        payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        if generation_config:
+            payload["generationConfig"] = generation_config
+
+        timeout = aiohttp.ClientTimeout(total=GEMINI_TIMEOUT, sock_connect=10)
+        async with self.gemini_slots, metrics.timer("gemini_request_seconds"):
+            async with self.get_session().post(
+                f"{GEMINI_API_URL}/models/{GEMINI_MODEL}:generateContent",
+                json=payload,
+                headers={"x-goog-api-key": GEMINI_API_KEY or ""},
+                timeout=timeout,
+            ) as response:
+                await self._raise_for_status("Gemini", response)
+                data = await response.json()
+
+        candidates = data.get("candidates") or []
+        if not candidates:
+            raise ProviderError("Gemini", 200, f"aucune réponse ({data.get('promptFeedback')})")
+        parts = candidates[0].get("content", {}).get("parts", [])
+        # Les parties "thought" (raisonnement du modèle) ne font pas partie du texte
+        return "".join(part.get("text", "") for part in parts if not part.get("thought")).strip()
+
+    async def elevenlabs_stream(self, api_key, text, previous_text=None, next_text=None, settings=None):
+        """Synthétise un texte et renvoie les chunks MP3 au fur et à mesure.
+        previous_text/next_text donnent le contexte d'un segment (prosodie continue).
+        settings : paramètres de voix figés au début de la synthèse (défaut : paramètres actuels)."""
+        settings = settings or current_tts_settings()
+        timeout = aiohttp.ClientTimeout(total=ELEVENLABS_TIMEOUT, sock_connect=10, sock_read=30)
+        payload = {
+            "text": text,
+            "model_id": TTS_MODEL_ID,
+            "voice_settings": current_voice_settings(settings),
+        }
+        if previous_text:
+            payload["previous_text"] = previous_text
+        if next_text:
+            payload["next_text"] = next_text
+        async with self.get_session().post(
+            f"{ELEVENLABS_API_URL}/text-to-speech/{settings['TTS_VOICE_ID']}/stream",
+            params={"output_format": TTS_OUTPUT_FORMAT},
+            json=payload,
+            headers={"xi-api-key": api_key},
+            timeout=timeout,
+        ) as response:
+            await self._raise_for_status("ElevenLabs", response)
+            async for chunk in response.content.iter_any():
+                if chunk:
+                    yield chunk
+
+    async def warmup(self):
+        """Ouvre la connexion (DNS + TLS) vers Gemini pendant le démarrage.
+        ElevenLabs est déjà contacté au démarrage pour les quotas des clés."""
+        timeout = aiohttp.ClientTimeout(total=15)
+        try:
+            async with self.get_session().get(
+                f"{GEMINI_API_URL}/models/{GEMINI_MODEL}",
+                headers={"x-goog-api-key": GEMINI_API_KEY or ""},
+                timeout=timeout,
+            ) as response:
+                await response.read()
+        except Exception as e:
+            print(f"⚠️ Préchauffage de la connexion Gemini impossible: {e}")
+
+    async def elevenlabs_subscription(self, api_key):
+        """Informations d'abonnement (quota de caractères) d'une clé"""
+        timeout = aiohttp.ClientTimeout(total=15)
+        async with self.get_session().get(
+            f"{ELEVENLABS_API_URL}/user/subscription",
+            headers={"xi-api-key": api_key},
+            timeout=timeout,
+        ) as response:
+            await self._raise_for_status("ElevenLabs", response)
+            return await response.json()
+
+
+providers = HTTPProviders()
+
+
+# ===== STORE PARTAGÉ ENTRE PROCESSUS (SHARDING) =====
+# Plusieurs processus du bot (un ou plusieurs shards chacun) sur la même machine
+# partagent une base SQLite en mode WAL : prompts prêts du buffer, état des clés
+# ElevenLabs et demande. Un seul processus génère (bail renouvelé), tous piochent.
+SHARED_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buffer (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    tts_file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fingerprint TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS keys (
+    key_id TEXT PRIMARY KEY,
+    remaining INTEGER,
+    reset_at REAL,
+    cooldown_until REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS producers (
+    owner TEXT PRIMARY KEY,
+    in_flight INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playing (
+    tts_file TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SharedStore:
+    """Base SQLite (WAL) partagée par les processus du bot.
+    Méthodes bloquantes : à appeler via run_in_executor."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # Une connexion, utilisée depuis les threads de l'executor
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SHARED_STORE_SCHEMA)
+
+    # Prompts synthétisés avec les paramètres de voix partagés (les autres sont périmés)
+    CURRENT = "fingerprint IS COALESCE((SELECT fingerprint FROM settings WHERE name = 'tts'), fingerprint)"
+
+    def push_entry(self, text, tts_file, size, fingerprint):
+        """Ajoute un prompt prêt. Retourne le nombre de prompts en stock."""
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO buffer (text, tts_file, size, fingerprint, created_at) VALUES (?, ?, ?, ?, ?)",
+                (text, tts_file, size, fingerprint, time.time()),
+            )
+            return self.db.execute(f"SELECT COUNT(*) FROM buffer WHERE {self.CURRENT}").fetchone()[0]
+
+    def pop_entry(self, owner, ttl):
+        """Retire le plus ancien prompt à jour (atomique entre processus). Son fichier reste protégé
+        du GC (bail de lecture) pendant `ttl`. Retourne (entrée ou None, prompts restants)."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    f"DELETE FROM buffer WHERE id = (SELECT MIN(id) FROM buffer WHERE {self.CURRENT}) "
+                    "RETURNING text, tts_file, size, fingerprint"
+                ).fetchall()
+                if rows:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO playing (tts_file, owner, expires_at) VALUES (?, ?, ?)",
+                        (rows[0]["tts_file"], owner, time.time() + ttl),
+                    )
+                count = self.db.execute(f"SELECT COUNT(*) FROM buffer WHERE {self.CURRENT}").fetchone()[0]
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return (dict(rows[0]) if rows else None), count
+
+    def count_entries(self):
+        with self.lock:
+            return self.db.execute(f"SELECT COUNT(*) FROM buffer WHERE {self.CURRENT}").fetchone()[0]
+
+    def take_stale(self):
+        """Retire les prompts synthétisés avec d'autres paramètres TTS que ceux du store"""
+        with self.lock:
+            rows = self.db.execute(
+                f"DELETE FROM buffer WHERE NOT ({self.CURRENT}) RETURNING text, tts_file"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def referenced_files(self):
+        """Fichiers encore utilisés : prompts en stock et prompts en cours de lecture"""
+        with self.lock:
+            self.db.execute("DELETE FROM playing WHERE expires_at < ?", (time.time(),))
+            return {row[0] for row in self.db.execute("SELECT tts_file FROM buffer UNION SELECT tts_file FROM playing")}
+
+    def acquire_lease(self, name, owner, ttl):
+        """Prend ou renouvelle un bail (libre, expiré ou déjà à nous). Retourne True si on le détient."""
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+    def reserve(self, owner, target, in_flight, ttl):
+        """Réserve les entrées qui manquent pour atteindre `target`, en comptant celles déjà
+        en cours chez les autres producteurs. Publie nos entrées en cours. Retourne le nombre réservé."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                ready = self.db.execute(f"SELECT COUNT(*) FROM buffer WHERE {self.CURRENT}").fetchone()[0]
+                others = self.db.execute(
+                    "SELECT COALESCE(SUM(in_flight), 0) FROM producers WHERE owner != ? AND expires_at >= ?",
+                    (owner, now),
+                ).fetchone()[0]
+                missing = max(0, target - ready - others - in_flight)
+                row = self.db.execute(
+                    "SELECT in_flight, expires_at FROM producers WHERE owner = ?", (owner,)
+                ).fetchone()
+                # Écriture seulement si quelque chose change (ou bail à mi-vie) : chaque écriture
+                # réveille les autres processus, qui réserveraient à leur tour, et ainsi de suite
+                if row is None or row["in_flight"] != in_flight + missing or row["expires_at"] - now < ttl / 2:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO producers (owner, in_flight, expires_at) VALUES (?, ?, ?)",
+                        (owner, in_flight + missing, now + ttl),
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return missing
+
+    def drop_producer(self, owner):
+        with self.lock:
+            self.db.execute("DELETE FROM producers WHERE owner = ?", (owner,))
+
+    def release_lease(self, name, owner):
+        with self.lock:
+            self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def save_key_state(self, key_id, remaining, reset_at, cooldown_until, updated_at):
+        try:
+            with self.lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO keys (key_id, remaining, reset_at, cooldown_until, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key_id, remaining, reset_at, cooldown_until, updated_at),
+                )
+        except sqlite3.Error as e:
+            print(f"⚠️ État de clé non partagé: {e}")
+
+    def consume_key(self, key_id, characters, updated_at):
+        """Décompte atomique du quota restant (sans écraser les décomptes des autres processus).
+        Retourne le quota restant partagé, ou None s'il est inconnu."""
+        with self.lock:
+            row = self.db.execute(
+                "UPDATE keys SET remaining = MAX(0, remaining - ?), updated_at = ? "
+                "WHERE key_id = ? AND remaining IS NOT NULL RETURNING remaining",
+                (characters, updated_at, key_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def pause_key(self, key_id, cooldown_until, updated_at):
+        """Met une clé en pause (la pause la plus longue l'emporte), sans toucher à son quota"""
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO keys (key_id, remaining, reset_at, cooldown_until, updated_at) VALUES (?, NULL, NULL, ?, ?) "
+                "ON CONFLICT(key_id) DO UPDATE SET cooldown_until = MAX(cooldown_until, excluded.cooldown_until), "
+                "updated_at = excluded.updated_at",
+                (key_id, cooldown_until, updated_at),
+            )
+
+    def load_key_states(self):
+        with self.lock:
+            return {row["key_id"]: dict(row) for row in self.db.execute("SELECT * FROM keys")}
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount),
+            )
+
+    def counter(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def init_settings(self, name, value, fingerprint):
+        """Enregistre des paramètres s'ils n'existent pas encore. Retourne ceux du store."""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO settings (name, value, fingerprint, updated_at) VALUES (?, ?, ?, ?)",
+                (name, json.dumps(value), fingerprint, time.time()),
+            )
+        return self.load_settings(name)
+
+    def save_settings(self, name, value, fingerprint):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO settings (name, value, fingerprint, updated_at) VALUES (?, ?, ?, ?)",
+                (name, json.dumps(value), fingerprint, time.time()),
+            )
+
+    def load_settings(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT value, fingerprint FROM settings WHERE name = ?", (name,)).fetchone()
+        return {"value": json.loads(row["value"]), "fingerprint": row["fingerprint"]} if row else None
+
+    def data_version(self):
+        """Change dès qu'un AUTRE processus a écrit dans la base (lecture d'un entier, sans requête)"""
+        with self.lock:
+            return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+
+class SharedCoordinator:
+    """Coordination des processus autour du store partagé : un seul générateur,
+    des prompts piochés par n'importe quel shard, une demande mesurée globalement"""
+
+    LEASE = "generator"
+
+    def __init__(self, store):
+        self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_generator = False
+        self.count = 0  # Prompts prêts dans le store (dernière lecture)
+        self.version = None
+        self.commands_seen = 0
+        self.task = None
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
+    async def start(self):
+        """Lit l'état initial et tente de prendre le rôle de générateur (une seule fois)"""
+        if self.version is not None:
+            return
+        self.version = await self.call(self.store.data_version)
+        self.commands_seen = await self.call(self.store.counter, "commands")
+        self.count = await self.call(self.store.count_entries)
+        # Paramètres de voix communs : le premier processus les initialise, les autres les reprennent
+        stored = await self.call(self.store.init_settings, "tts", current_tts_settings(), tts_fingerprint())
+        apply_tts_settings(stored["value"])
+        if CHAOS_ROLE == "gateway":
+            return  # Ne génère jamais : pas de candidature au bail
+        await self._renew()
+        self.task = asyncio.create_task(self._hold_lease())
+
+    def produces(self):
+        """Ce processus remplit-il le buffer commun ? Les workers toujours (leurs réservations
+        évitent les doublons), un processus complet seulement s'il détient le bail."""
+        if CHAOS_ROLE == "worker":
+            return True
+        return CHAOS_ROLE == "all" and self.is_generator
+
+    async def reserve(self, target, in_flight):
+        return await self.call(self.store.reserve, self.owner, target, in_flight, PRODUCER_TTL)
+
+    async def _renew(self):
+        try:
+            leader = await self.call(self.store.acquire_lease, self.LEASE, self.owner, GENERATOR_LEASE_TTL)
+        except sqlite3.Error as e:
+            print(f"⚠️ Bail du générateur non renouvelé: {e}")
+            return
+        if leader != self.is_generator:
+            self.is_generator = leader
+            print(f"🏭 Processus {self.owner}: {'générateur du buffer' if leader else 'consommateur du buffer'}")
+            if leader:
+                signal_refill()
+
+    async def _hold_lease(self):
+        while True:
+            await asyncio.sleep(GENERATOR_LEASE_TTL / 3)
+            await self._renew()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.call(self.store.drop_producer, self.owner)
+        if self.is_generator:
+            # Un autre processus peut reprendre la génération sans attendre l'expiration
+            await self.call(self.store.release_lease, self.LEASE, self.owner)
+            self.is_generator = False
+
+    async def refresh(self):
+        """Relit le store si un autre processus y a écrit. Retourne True si c'est le cas."""
+        version = await self.call(self.store.data_version)
+        if version == self.version:
+            return False
+        self.version = version
+        self.count = await self.call(self.store.count_entries)
+        # Paramètres de voix modifiés par une commande reçue sur un autre processus
+        await self.sync_settings()
+        # Commandes reçues par les autres processus : même estimation de la demande partout
+        commands = await self.call(self.store.counter, "commands")
+        for _ in range(commands - self.commands_seen):
+            demand.record_command()
+        self.commands_seen = max(self.commands_seen, commands)
+        return True
+
+    def record_command(self):
+        demand.record_command()
+        self.commands_seen += 1
+        spawn(self.call(self.store.incr, "commands"))
+
+    async def sync_settings(self):
+        """Reprend les paramètres de voix du store (avant chaque synthèse). Retourne True s'ils ont changé."""
+        stored = await self.call(self.store.load_settings, "tts")
+        if stored is None or not apply_tts_settings(stored["value"]):
+            return False
+        print(f"🎛️ Paramètres TTS repris du store partagé (empreinte {stored['fingerprint']})")
+        if self.produces():
+            spawn(refresh_stale_entries())
+        return True
+
+    async def publish_settings(self):
+        """Partage les paramètres de voix de ce processus (après une commande de réglage)"""
+        await self.call(self.store.save_settings, "tts", current_tts_settings(), tts_fingerprint())
+
+    async def push(self, text, data, fingerprint):
+        """Écrit l'audio dans le spool commun et publie le prompt pour tous les processus"""
+        packets = await encode_tts_opus(data)
+        path = await self.call(write_audio_files_sync, SPOOL_DIR, data, packets)
+        self.count = await self.call(self.store.push_entry, text, os.path.basename(path), len(data), fingerprint)
+
+    async def pop(self):
+        """Pioche un prompt prêt (ou None). Le fichier revient à ce processus, qui le supprime après lecture."""
+        row, path, self.count = await self.call(self._pop_sync)
+        if row is None:
+            return None
+        return {
+            "text": row["text"],
+            "audio": audio_store.adopt(path, row["size"]),
+            "fingerprint": row["fingerprint"],
+        }
+
+    def _pop_sync(self):
+        """Exécuté hors de la boucle : pioche et vérification du fichier (entrées sans fichier ignorées)"""
+        while True:
+            row, count = self.store.pop_entry(self.owner, SPOOL_PLAYING_TTL)
+            if row is None:
+                return None, None, count
+            path = os.path.join(SPOOL_DIR, row["tts_file"])
+            if os.path.isfile(path):
+                return row, path, count
+
+    async def take_stale(self):
+        """Retire les prompts périmés du store et supprime leurs fichiers. Retourne leurs textes."""
+        rows = await self.call(self.store.take_stale)
+        for row in rows:
+            await self.call(remove_tts_file_sync, os.path.join(SPOOL_DIR, row["tts_file"]))
+        self.count = await self.call(self.store.count_entries)
+        return [row["text"] for row in rows]
+
+
+shared_store = SharedStore(SHARED_STORE_PATH) if SHARED_STORE_PATH else None
+shared_coordinator = SharedCoordinator(shared_store) if shared_store else None
+
+
+class ElevenLabsKey:
+    """État de santé d'une clé ElevenLabs"""
+
+    def __init__(self, index, api_key):
+        self.index = index
+        self.api_key = api_key
+        self.remaining = None  # Caractères restants (None = inconnu)
+        self.reset_at = None  # Timestamp de remise à zéro du quota
+        self.cooldown_until = 0.0  # Clé mise de côté jusqu'à ce timestamp
+        self.in_flight = 0  # Requêtes en cours sur cette clé
+        self.requests = 0
+        self.errors = 0
+        self.characters = 0  # Caractères consommés depuis le démarrage
+        self.key_id = hashlib.sha1(api_key.encode()).hexdigest()[:12]  # Identifiant partagé (jamais la clé)
+        self.updated_at = 0.0  # Dernière modification de l'état partagé
+
+    @property
+    def label(self):
+        return f"Clé {self.index + 1}/{len(ELEVENLABS_API_KEYS)}"
+
+
+class ElevenLabsKeyPool:
+    """Pool de clés ElevenLabs partagé par toutes les tâches.
+    Répartit les requêtes simultanées sur les clés saines, met de côté les clés
+    épuisées jusqu'à la remise à zéro de leur quota puis les réintègre automatiquement."""
+
+    def __init__(self, api_keys, max_per_key):
+        self.keys = [ElevenLabsKey(i, api_key) for i, api_key in enumerate(api_keys)]
+        self.max_per_key = max_per_key
+        self.lock = asyncio.Lock()
+        self.changed = asyncio.Event()  # Remplacé à chaque changement d'état (voir _notify)
+        self.synced_at = 0.0
+
+    def _is_healthy(self, key, characters, now):
+        if key.cooldown_until > now:
+            return False
+        return key.remaining is None or key.remaining >= characters
+
+    def _revive(self, now):
+        """Réintègre les clés dont la pause est terminée ou dont le quota a été remis à zéro"""
+        for key in self.keys:
+            if key.cooldown_until and key.cooldown_until <= now:
+                key.cooldown_until = 0.0
+                if key.remaining == 0:
+                    key.remaining = None  # Quota remis à zéro, valeur exacte inconnue
+                print(f"♻️ {key.label} de nouveau disponible")
+            if key.reset_at and key.reset_at <= now and key.remaining is not None:
+                key.remaining = None
+                key.reset_at = None
+                print(f"♻️ {key.label}: quota remis à zéro")
+
+    def _pause_exhausted(self, key, now):
+        """Met de côté une clé sans quota suffisant jusqu'à la remise à zéro (sinon ELEVENLABS_KEY_COOLDOWN)"""
+        key.remaining = 0
+        key.cooldown_until = key.reset_at if key.reset_at and key.reset_at > now else now + ELEVENLABS_KEY_COOLDOWN
+        print(f"⚠️ {key.label} épuisée, en pause jusqu'à {time.strftime('%d/%m %H:%M', time.localtime(key.cooldown_until))}")
+        self._publish(key)
+
+    async def acquire(self, characters, timeout=60):
+        """Réserve la clé saine la moins chargée.
+        Retourne None si aucune clé ne peut servir cette requête."""
+        with metrics.timer("elevenlabs_key_wait_seconds"):
+            await self.sync_shared()
+            return await self._acquire(characters, timeout)
+
+    def _publish(self, key):
+        """Publie l'état de la clé pour les autres processus (store partagé)"""
+        key.updated_at = time.time()
+        if shared_store is None:
+            return
+        loop = asyncio.get_running_loop()
+        spawn(loop.run_in_executor(None, shared_store.save_key_state,
+                                   key.key_id, key.remaining, key.reset_at, key.cooldown_until, key.updated_at))
+
+    def _consume_shared(self, key, characters):
+        """Décompte partagé : soustraction dans le store, pas de réécriture d'une valeur lue avant"""
+        key.updated_at = time.time()
+        if shared_store is not None:
+            spawn(self._write_consume(key, characters, key.updated_at))
+
+    async def _write_consume(self, key, characters, updated_at):
+        loop = asyncio.get_running_loop()
+        remaining = await loop.run_in_executor(None, shared_store.consume_key, key.key_id, characters, updated_at)
+        # Quota restant après les décomptes de tous les processus
+        if remaining is not None and key.updated_at == updated_at:
+            key.remaining = remaining
+
+    def _pause_shared(self, key):
+        """Pause partagée (erreur passagère) : seule la date de fin de pause est écrite"""
+        key.updated_at = time.time()
+        if shared_store is not None:
+            loop = asyncio.get_running_loop()
+            spawn(loop.run_in_executor(None, shared_store.pause_key, key.key_id, key.cooldown_until, key.updated_at))
+
+    async def sync_shared(self):
+        """Reprend l'état des clés modifié par les autres processus (quota, pause).
+        La modification la plus récente l'emporte (les décomptes sont, eux, cumulés dans le store)."""
+        now = time.time()
+        if shared_store is None or now - self.synced_at < KEY_SYNC_INTERVAL:
+            return
+        self.synced_at = now
+        loop = asyncio.get_running_loop()
+        try:
+            states = await loop.run_in_executor(None, shared_store.load_key_states)
+        except sqlite3.Error as e:
+            print(f"⚠️ État partagé des clés illisible: {e}")
+            return
+        async with self.lock:
+            for key in self.keys:
+                state = states.get(key.key_id)
+                if state and state["updated_at"] > key.updated_at:
+                    key.remaining = state["remaining"]
+                    key.reset_at = state["reset_at"]
+                    key.cooldown_until = state["cooldown_until"]
+                    key.updated_at = state["updated_at"]
+            self._notify()
+
+    async def _acquire(self, characters, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            async with self.lock:
+                now = time.time()
+                self._revive(now)
+                remaining_time = deadline - loop.time()
+                healthy = [k for k in self.keys if self._is_healthy(k, characters, now)]
+                if not healthy:
+                    # Quota restant trop faible pour cette requête : pause jusqu'à la remise à zéro
+                    for k in self.keys:
+                        if k.cooldown_until <= now and k.remaining is not None and k.remaining < characters:
+                            self._pause_exhausted(k, now)
+                    # Pause courte (erreur passagère) qui se termine à temps : on l'attend
+                    paused = [k.cooldown_until for k in self.keys if k.cooldown_until > now]
+                    if not paused or min(paused) - now > remaining_time:
+                        print("❌ Toutes les clés ElevenLabs sont épuisées !")
+                        return None
+                    wait = min(paused) - now
+                else:
+                    available = [k for k in healthy if k.in_flight < self.max_per_key]
+                    if available:
+                        # Moins de requêtes en cours d'abord, puis le plus de quota restant
+                        key = min(available, key=lambda k: (k.in_flight, -(k.remaining if k.remaining is not None else float('inf'))))
+                        key.in_flight += 1
+                        key.requests += 1
+                        return key
+
+                    # Toutes les clés saines sont occupées : attendre qu'une se libère
+                    if remaining_time <= 0:
+                        print("⏳ Aucune clé ElevenLabs libre à temps")
+                        return None
+                    wait = remaining_time
+                changed = self.changed
+
+            # Attente hors du verrou (annulation sans risque), réveillée à chaque changement d'état
+            try:
+                await asyncio.wait_for(changed.wait(), min(max(wait, 0.05), 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self):
+        """Réveille les tâches qui attendent une clé"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def _update(self, key, characters, error):
+        key.in_flight -= 1
+        if error is None:
+            key.characters += characters
+            if key.remaining is not None:
+                key.remaining = max(0, key.remaining - characters)
+                self._consume_shared(key, characters)
+        elif is_quota_error(error):
+            key.errors += 1
+            metrics.inc("elevenlabs_key_exhausted_total")
+            self._pause_exhausted(key, time.time())
+        elif is_key_health_error(error):
+            key.errors += 1
+            metrics.inc("elevenlabs_key_errors_total")
+            key.cooldown_until = max(key.cooldown_until, time.time() + ELEVENLABS_ERROR_COOLDOWN)
+            self._pause_shared(key)
+        else:
+            # Requête invalide, coupure réseau, panne du service... : la clé n'y est pour rien
+            metrics.inc("elevenlabs_request_errors_total")
+
+    async def release(self, key, characters=0, error=None):
+        """Libère la clé et met à jour son état selon le résultat de la requête"""
+        async with self.lock:
+            self._update(key, characters, error)
+            self._notify()
+
+    async def refresh_quota(self, key):
+        """Interroge l'API pour connaître le quota restant d'une clé"""
+        try:
+            subscription = await providers.elevenlabs_subscription(key.api_key)
+            async with self.lock:
+                key.remaining = max(0, subscription["character_limit"] - subscription["character_count"])
+                key.reset_at = subscription.get("next_character_count_reset_unix")
+                if key.remaining == 0 and key.reset_at:
+                    key.cooldown_until = key.reset_at
+                self._publish(key)
+                self._notify()
+        except Exception as e:
+            print(f"⚠️ Quota inconnu pour la {key.label}: {e}")
+
+    async def refresh_all(self):
+        await asyncio.gather(*(self.refresh_quota(key) for key in self.keys))
+
+    async def reset(self):
+        """Réintègre toutes les clés immédiatement (commande manuelle)"""
+        async with self.lock:
+            for key in self.keys:
+                key.cooldown_until = 0.0
+                key.remaining = None
+                self._publish(key)
+            self._notify()
+
+
+elevenlabs_keys = ElevenLabsKeyPool(ELEVENLABS_API_KEYS, ELEVENLABS_MAX_CONCURRENCY_PER_KEY)
+
+
+# ===== DURÉE DES MP3 (EN-TÊTES DE TRAMES) =====
+# Tables MPEG audio : bitrates (kbit/s) et fréquences d'échantillonnage
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+
+def mp3_frames(data):
+    """Parcourt les trames audio d'un MP3 : (position, longueur, durée) de chaque trame.
+    Le tag ID3v2 et la trame Xing/Info (sans audio) sont ignorés."""
+    pos = 0
+    # Sauter le tag ID3v2 éventuel
+    if data[:3] == b"ID3" and len(data) >= 10:
+        tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        pos = 10 + tag_size
+
+    frames = 0
+    end = len(data) - 4
+    while pos <= end:
+        if data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+            pos += 1
+            continue
+
+        b1, b2 = data[pos + 1], data[pos + 2]
+        version_bits = (b1 >> 3) & 0x03
+        layer_bits = (b1 >> 1) & 0x03
+        bitrate_index = (b2 >> 4) & 0x0F
+        rate_index = (b2 >> 2) & 0x03
+        padding = (b2 >> 1) & 0x01
+
+        if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+            pos += 1
+            continue
+
+        version = {3: 1, 2: 2, 0: 2.5}[version_bits]
+        layer = 4 - layer_bits
+        bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+
+        if layer == 1:
+            samples = 384
+            frame_length = (12 * bitrate // sample_rate + padding) * 4
+        else:
+            samples = 1152 if (layer == 2 or version == 1) else 576
+            frame_length = samples // 8 * bitrate // sample_rate + padding
+
+        if frame_length <= 0:
+            pos += 1
+            continue
+
+        # La première trame peut être un en-tête Xing/Info (sans audio)
+        frame = data[pos:pos + frame_length]
+        if frames == 0 and (b"Xing" in frame or b"Info" in frame):
+            pos += frame_length
+            continue
+
+        yield pos, frame_length, samples / sample_rate
+        frames += 1
+        pos += frame_length
 
-def rotate_elevenlabs_key():
-    """Passe à la clé API ElevenLabs suivante. Retourne True si on a pu changer, False si plus de clés."""
-    global current_elevenlabs_key_index, elevenlabs_client
-    
-    current_elevenlabs_key_index += 1
-    
-    if current_elevenlabs_key_index >= len(ELEVENLABS_API_KEYS):
-        print("❌ Toutes les clés ElevenLabs sont épuisées !")
-        return False
-    
-    new_key = ELEVENLABS_API_KEYS[current_elevenlabs_key_index]
-    elevenlabs_client = ElevenLabs(api_key=new_key)
-    print(f"🔄 Rotation vers la clé ElevenLabs #{current_elevenlabs_key_index + 1}/{len(ELEVENLABS_API_KEYS)}")
-    return True
 
-def get_current_key_info():
-    """Retourne les infos sur la clé actuelle"""
-    return f"Clé {current_elevenlabs_key_index + 1}/{len(ELEVENLABS_API_KEYS)}"
+def mp3_duration(data):
+    """Calcule la durée d'un MP3 en parcourant les en-têtes de trames (sans ffprobe)"""
+    durations = [duration for _, _, duration in mp3_frames(data)]
+    return sum(durations) if durations else None
+
+
+def mp3_audio_payload(data):
+    """Ne garde que les trames audio d'un MP3 (sans ID3 ni Xing/Info) pour le raccorder à un autre"""
+    first = last = None
+    for pos, length, _ in mp3_frames(data):
+        if first is None:
+            first = pos
+        last = pos + length
+    return data[first:last] if first is not None else b""
 
 
 def get_audio_duration(file_path):
-    """Obtient la durée exacte d'un fichier audio en secondes via ffprobe"""
+    """Obtient la durée d'un fichier MP3 en secondes, calculée dans le process"""
     try:
-        result = subprocess.run(
-            [
-                'ffprobe',
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format',
-                file_path
-            ],
-            capture_output=True,
-            text=True
-        )
+        with open(file_path, 'rb') as f, metrics.timer("mp3_duration_seconds"):
+            duration = mp3_duration(f.read())
+        if duration:
+            print(f"📏 Durée audio: {duration:.2f}s")
+            return duration
+    except Exception as e:
+        print(f"⚠️ Impossible d'obtenir la durée exacte: {e}")
+    
+    return None
+
+# ===== CLIPS STATIQUES EN MÉMOIRE =====
+# Format PCM attendu par discord.py : 48 kHz, stéréo, 16 bits, trames de 20 ms
+PCM_SAMPLE_RATE = 48000
+PCM_CHANNELS = 2
+PCM_BYTES_PER_SECOND = PCM_SAMPLE_RATE * PCM_CHANNELS * 2
+PCM_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+OPUS_FRAME_DURATION = discord.opus.Encoder.FRAME_LENGTH / 1000
+# Pré-encodage Opus : l'audio est encodé une fois, la lecture envoie les paquets tels quels
+OPUS_PREENCODE = os.getenv('OPUS_PREENCODE', '1') == '1'
+
+# Clips décodés une seule fois au démarrage
+STATIC_CLIP_FILES = ["kaamelott.mp3"]
+static_clips = {}  # {chemin: StaticClip}
+
+
+class StaticClip:
+    """Clip audio décodé une fois en PCM (et encodé en Opus si possible) et gardé en mémoire"""
+
+    def __init__(self, name, pcm, packets=None):
+        # Compléter la dernière trame avec du silence
+        remainder = len(pcm) % PCM_FRAME_SIZE
+        if remainder:
+            pcm += b"\x00" * (PCM_FRAME_SIZE - remainder)
+        self.name = name
+        self.pcm = pcm
+        self.packets = packets  # Paquets Opus de 20 ms (None si libopus indisponible)
+        self.duration = len(pcm) / PCM_BYTES_PER_SECOND
+
+    def source(self):
+        """Source discord.py pour une lecture du clip"""
+        if self.packets:
+            return OpusPacketAudio(self.packets)
+        return MemoryPCMAudio(self)
+
+
+class MemoryPCMAudio(discord.AudioSource):
+    """Source audio qui lit un clip PCM déjà en mémoire (pas de process FFmpeg)"""
+
+    def __init__(self, clip):
+        self.view = memoryview(clip.pcm)
+        self.position = 0
+        self.duration = clip.duration
+
+    def read(self):
+        frame = self.view[self.position:self.position + PCM_FRAME_SIZE]
+        self.position += PCM_FRAME_SIZE
+        if len(frame) < PCM_FRAME_SIZE:
+            return b""
+        return bytes(frame)
+
+    def is_opus(self):
+        return False
+
+
+class OpusPacketAudio(discord.AudioSource):
+    """Source audio qui envoie des paquets Opus déjà encodés (ni FFmpeg ni encodage à la lecture)"""
+
+    def __init__(self, packets):
+        self.packets = packets
+        self.position = 0
+        self.duration = len(packets) * OPUS_FRAME_DURATION
+
+    def read(self):
+        if self.position >= len(self.packets):
+            return b""
+        packet = self.packets[self.position]
+        self.position += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+
+def encode_opus_packets(pcm):
+    """Encode du PCM 48 kHz stéréo en paquets Opus de 20 ms (lève une exception sans libopus)"""
+    encoder = discord.opus.Encoder()
+    remainder = len(pcm) % PCM_FRAME_SIZE
+    if remainder:
+        pcm += b"\x00" * (PCM_FRAME_SIZE - remainder)
+    return [
+        encoder.encode(pcm[i:i + PCM_FRAME_SIZE], encoder.SAMPLES_PER_FRAME)
+        for i in range(0, len(pcm), PCM_FRAME_SIZE)
+    ]
+
+
+def write_opus_packets_sync(path, packets):
+    """Écrit les paquets dans un fichier (longueur sur 2 octets + paquet), de façon atomique"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for packet in packets:
+            f.write(struct.pack(">H", len(packet)))
+            f.write(packet)
+    os.replace(tmp_path, path)
+
+
+def read_opus_packets_sync(path):
+    """Relit un fichier de paquets Opus écrit par write_opus_packets_sync"""
+    with open(path, "rb") as f:
+        data = f.read()
+    packets = []
+    pos = 0
+    while pos + 2 <= len(data):
+        (length,) = struct.unpack_from(">H", data, pos)
+        packets.append(data[pos + 2:pos + 2 + length])
+        pos += 2 + length
+    return packets
+
+
+def opus_sidecar(tts_file):
+    """Chemin du fichier de paquets Opus associé à un fichier TTS"""
+    return os.path.splitext(tts_file)[0] + ".opus"
+
+
+def decode_pcm_sync(audio):
+    """Décode un audio (chemin ou contenu MP3) en PCM brut avec FFmpeg
+    (fonction synchrone pour run_in_executor)"""
+    in_memory = isinstance(audio, bytes)
+    result = subprocess.run(
+        [
+            'ffmpeg',
+            '-v', 'quiet',
+            '-i', 'pipe:0' if in_memory else audio,
+            '-f', 's16le',
+            '-ar', str(PCM_SAMPLE_RATE),
+            '-ac', str(PCM_CHANNELS),
+            'pipe:1'
+        ],
+        input=audio if in_memory else None,
+        capture_output=True
+    )
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f"FFmpeg a échoué (code {result.returncode})")
+    return result.stdout
+
+
+def decode_static_clip_sync(audio_file):
+    """Décode un clip statique en PCM puis, si possible, en paquets Opus"""
+    pcm = decode_pcm_sync(audio_file)
+    packets = None
+    if OPUS_PREENCODE:
+        try:
+            packets = encode_opus_packets(pcm)
+        except Exception as e:
+            print(f"⚠️ Encodage Opus du clip '{audio_file}' impossible, lecture en PCM: {e}")
+    return StaticClip(audio_file, pcm, packets)
+
+
+def transcode_tts_opus_sync(data):
+    """Transcode un MP3 TTS en paquets Opus (une seule fois, à la génération)"""
+    return encode_opus_packets(decode_pcm_sync(data))
+
+
+def remove_tts_file_sync(tts_file):
+    """Supprime un fichier TTS et ses paquets Opus éventuels"""
+    for path in (tts_file, opus_sidecar(tts_file)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+async def load_static_clips():
+    """Décode les clips statiques (intro...) une seule fois"""
+    loop = asyncio.get_event_loop()
+    for audio_file in STATIC_CLIP_FILES:
+        if audio_file in static_clips or not os.path.exists(audio_file):
+            continue
+        try:
+            clip = await loop.run_in_executor(None, decode_static_clip_sync, audio_file)
+            static_clips[audio_file] = clip
+            encoding = f"{len(clip.packets)} paquets Opus" if clip.packets else f"{len(clip.pcm)} bytes PCM"
+            print(f"🎵 Clip '{audio_file}' chargé en mémoire ({clip.duration:.2f}s, {encoding})")
+        except Exception as e:
+            print(f"⚠️ Impossible de pré-décoder '{audio_file}', lecture via FFmpeg: {e}")
+
+# Créer le bot
+intents = discord.Intents.default()
+intents.message_content = True
+intents.voice_states = True
+intents.guilds = True
+intents.members = True
+intents.presences = True
+
+
+class StartupState:
+    """Étapes du démarrage à froid (secondes depuis le lancement), affichées par !buffer"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.milestones = {}  # {étape: secondes}, dans l'ordre d'arrivée
+
+    def mark(self, milestone):
+        """Enregistre une étape (seule la première occurrence compte)"""
+        if milestone in self.milestones:
+            return
+        self.milestones[milestone] = time.monotonic() - self.started
+        print(f"⏱️ Démarrage: {milestone} ({self.milestones[milestone]:.1f}s)")
+
+    def is_ready(self):
+        """Prêt = un !chaos peut être servi depuis le buffer"""
+        return "premier prompt" in self.milestones
+
+    def status(self):
+        if self.is_ready():
+            state = "🟢 Prêt (`!chaos` instantané)"
+        elif "préparation terminée" in self.milestones:
+            state = "🟡 Remplissage initial (`!chaos` en génération directe en attendant)"
+        else:
+            state = "🔴 Démarrage en cours"
+        steps = " · ".join(f"{name} {seconds:.1f}s" for name, seconds in self.milestones.items())
+        return f"{state}\n{steps}" if steps else state
+
+
+startup = StartupState()
+
+
+class ChaosBot(commands.AutoShardedBot):
+    """Bot shardé (SHARD_IDS/SHARD_COUNT pour répartir les shards entre processus)
+    avec fermeture propre des connexions HTTP aux fournisseurs"""
+
+    async def setup_hook(self):
+        # Appelé juste après la connexion HTTP, avant la gateway : la préparation
+        # (spool, historique, clips, quotas, buffer) avance pendant la connexion
+        startup.mark("connexion")
+        loop_watchdog.start()
+        self.warm_start_task = asyncio.create_task(warm_start())
+
+    async def close(self):
+        await providers.close()
+        if shared_coordinator is not None:
+            await shared_coordinator.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await super().close()
+
+
+bot = ChaosBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+# Variable pour stocker le dernier prompt envoyé
+last_prompt = None
+
+# ===== SYSTÈME DE BUFFER DE PROMPTS PRÉ-GÉNÉRÉS =====
+# Structure: {"text": str, "audio": AudioHandle, "fingerprint": str}
+# La profondeur visée s'adapte à la demande observée, entre ces deux bornes
+BUFFER_MIN_SIZE = int(os.getenv('BUFFER_MIN_SIZE', '1'))
+BUFFER_MAX_SIZE = int(os.getenv('BUFFER_MAX_SIZE', '10'))
+BUFFER_DEFAULT_SIZE = 3  # Profondeur tant qu'aucune mesure n'est disponible
+# Budget quotidien de caractères ElevenLabs pour le remplissage du buffer (0 = illimité)
+BUFFER_DAILY_CHARACTER_BUDGET = int(os.getenv('BUFFER_DAILY_CHARACTER_BUDGET', '0'))
+# Demi-vie (secondes) de l'estimation du débit de commandes
+DEMAND_HALF_LIFE = float(os.getenv('DEMAND_HALF_LIFE', '300'))
+prompt_buffer = deque()
+refill_event = asyncio.Event()  # Signalé quand le buffer a peut-être besoin d'être rempli
+refill_task = None
+# Backoff (secondes) après des erreurs de génération consécutives
+REFILL_BACKOFF_BASE = 2
+REFILL_BACKOFF_MAX = 120
+buffer_lock = asyncio.Lock()  # Lock pour éviter les race conditions
+
+# ===== CONFIGURATION DU PIPELINE DE GÉNÉRATION =====
+TEXT_CONCURRENCY = int(os.getenv('TEXT_CONCURRENCY', '2'))  # Appels Gemini simultanés
+# Appels ElevenLabs simultanés (par défaut : proportionnel au nombre de clés)
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', str(max(2, len(ELEVENLABS_API_KEYS) * ELEVENLABS_MAX_CONCURRENCY_PER_KEY))))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '2'))  # Textes en attente de TTS
+# Paragraphes demandés au maximum par requête Gemini (1 = pas de lot)
+GEMINI_BATCH_SIZE = int(os.getenv('GEMINI_BATCH_SIZE', '3'))
+
+# ===== SPOOL PERSISTANT =====
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')  # Dossier des fichiers TTS du buffer
+SPOOL_MANIFEST = os.path.join(SPOOL_DIR, "manifest.json")
+os.makedirs(SPOOL_DIR, exist_ok=True)
+spool_lock = asyncio.Lock()  # Sérialise les écritures du manifeste
+spool_loaded = False
+opus_available = True  # Passe à False si libopus est introuvable (plus de tentatives)
+
+# ===== CONFIGURATION DES SESSIONS =====
+# Nombre maximum de serveurs qui jouent un !chaos en même temps (0 = illimité : chaque
+# serveur a sa propre file, le débit croît avec le nombre de serveurs). Limite optionnelle
+# pour une machine très modeste, au prix de serveurs qui attendent derrière d'autres.
+MAX_CONCURRENT_SESSIONS = int(os.getenv('MAX_CONCURRENT_SESSIONS', '0'))
+# Durée (secondes) pendant laquelle une connexion vocale inutilisée reste ouverte
+VOICE_IDLE_TIMEOUT = float(os.getenv('VOICE_IDLE_TIMEOUT', '120'))
+# !chaos en attente au maximum par canal vocal (au-delà, la commande est refusée)
+CHAOS_QUEUE_MAX_DEPTH = int(os.getenv('CHAOS_QUEUE_MAX_DEPTH', '3'))
+# Fenêtre (secondes) pendant laquelle un nouveau !chaos pour le même canal rejoint
+# la demande déjà en attente au lieu d'ajouter une lecture (0 = pas de regroupement)
+CHAOS_COALESCE_WINDOW = float(os.getenv('CHAOS_COALESCE_WINDOW', '10'))
+
+# ===== CONFIGURATION TTS =====
+# Voix disponibles: https://elevenlabs.io/docs/voices
+TTS_VOICE_ID = "iMij959nvbX8f2SxyrvX"  # Voice ID de la voix sélectionnée
+TTS_SPEED = 1.2  # Vitesse de lecture (0.5 à 2.0, défaut 1.0)
+TTS_SIMILARITY_BOOST = 1.00  # Similarity Boost (0.0 à 1.0, défaut 0.75)
+TTS_STABILITY = 1.00  # Stabilité (0.0 à 1.0, défaut 0.5)
+TTS_STYLE = 0.5  # Style (0.0 à 1.0, défaut 0.0)
+TTS_USE_SPEAKER_BOOST = True  # Utiliser speaker boost
+TTS_MODEL_ID = "eleven_multilingual_v2"
+TTS_OUTPUT_FORMAT = "mp3_44100_128"
+# Streaming : le TTS du mode fallback est joué pendant qu'ElevenLabs l'envoie
+TTS_STREAMING = os.getenv('TTS_STREAMING', '1') == '1'
+# Synthèse phrase par phrase en parallèle : la lecture démarre dès la première phrase
+TTS_SENTENCE_PARALLEL = os.getenv('TTS_SENTENCE_PARALLEL', '1') == '1'
+# Phrases plus courtes regroupées avec la suivante (moins de requêtes, meilleure prosodie)
+TTS_SEGMENT_MIN_LENGTH = int(os.getenv('TTS_SEGMENT_MIN_LENGTH', '50'))
+
+# Cache des audios déjà synthétisés (même texte + mêmes paramètres)
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'tts_cache')
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_MB', '200')) * 1024 * 1024
+TTS_CACHE_MAX_AGE = float(os.getenv('TTS_CACHE_MAX_AGE_DAYS', '7')) * 86400
+
+# Audios prêts à jouer gardés en mémoire ; au-delà du budget, ils sont déplacés sur disque
+AUDIO_STORE_MAX_BYTES = int(os.getenv('AUDIO_STORE_MAX_MB', '64')) * 1024 * 1024
+
+# Dictionnaire des voix prédéfinies (exemple)
+VOICES_PRESETS = {
+    "default": "iMij959nvbX8f2SxyrvX",
+    "bella": "EXAVITQu4vr4xnSDxMaL",
+    "adam": "pNInz6obpgDQGcFmaJgB",
+    "arnold": "jBpfuIE2acIp3nSgFhAH",
+    "george": "JBFqnCBsd6RMkjW3MqDE",
+    "callum": "N2lVS1w4EtoT3dr4eOWO",
+}
+
+# Prompt de base pour !chaos
+BASE_CHAOS_PROMPT = """Génère un paragraphe de 3 à 4 phrases, sous forme d'histoire absurde qui enchaîne des ordres étranges. Le texte doit être dérangeant, choquant, absurde, mais chaque action doit avoir une justification interne, comme si tout obéissait à une logique bizarre mais cohérente dans cet univers.
+Le ton doit être sérieux, comme si tu donnais des instructions vitales.
+
+Les phrases doivent être courtes, directes, non poétiques, et chaque phrase doit suivre le schéma :
+ordre absurde + justification étrange mais logique dans ce monde.
+
+Voici le style exact à imiter :
+« Vive le chaos. Esport, paris sportifs, twitch, casinos en ligne = arnaque, match fixé. Salut, l'enfer n'existe pas, n'aie pas peur de la mort et tu seras plus fort. Ouvre ton robinet tous les soirs et ne l'éteins jamais. Ajoute de l'eau de javel à la nourriture et jette-la dans la foret et dans la mer avec le plastique. L'argent viendra. Je détruis le monde, tu peux m'aider en faisant ces quelques actions énoncées au-dessus. »
+
+Respecte ce ton, cette structure, et cette logique absurde mais cohérente. Pas de descriptions poétiques, pas de métaphores longues, juste des ordres étranges + explications étranges.
+
+IMPORTANT: Beaucoup de textes ont DÉJÀ été générés. Tu DOIS absolument éviter de les reproduire ou de générer quelque chose de similaire. Crée quelque chose de complètement différent.
+{history}
+
+Ne me fait pas de liste, ne numérote pas les phrases, ne les sépare pas par des tirets. Écris simplement le paragraphe avec les phrases à la suite les unes des autres.
+Et commence le paragraphe par "Vive le chaos !".
+"""
+
+# Prompt pour générer plusieurs paragraphes en une requête (réponse JSON)
+BATCH_CHAOS_PROMPT = """Génère {count} paragraphes DIFFÉRENTS les uns des autres (thèmes, ordres et justifications différents).
+Chaque paragraphe doit respecter toutes les consignes suivantes :
+
+{instructions}
+Réponds uniquement avec un tableau JSON de {count} chaînes de caractères, une chaîne par paragraphe.
+"""
+
+def build_chaos_prompt():
+    """Construit le prompt avec un résumé de taille fixe de l'historique"""
+    return BASE_CHAOS_PROMPT.format(history=chaos_history.summary())
+
+
+def build_chaos_batch_prompt(count):
+    """Prompt qui demande `count` paragraphes distincts en une seule réponse"""
+    return BATCH_CHAOS_PROMPT.format(count=count, instructions=build_chaos_prompt())
+
+
+# ===== DÉTECTION DES QUASI-DOUBLONS =====
+# Index MinHash + LSH sur tout l'historique des textes générés : les doublons sont
+# rejetés avant de dépenser du TTS, et le prompt n'a besoin que d'un résumé.
+HISTORY_FILE = os.getenv('HISTORY_FILE', 'history.jsonl')
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.5'))  # Similarité de Jaccard estimée
+MAX_TEXT_ATTEMPTS = 3  # Générations Gemini max pour obtenir un texte inédit (buffer)
+CHAOS_TEXT_MIN_LENGTH = 80  # Bornes de longueur d'un paragraphe valide (mode lot)
+CHAOS_TEXT_MAX_LENGTH = 1500
+SHINGLE_SIZE = 3  # Mots par shingle
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bandes de 4 valeurs
+MINHASH_PRIME = (1 << 61) - 1
+
+# Mots trop courants pour décrire un thème
+FRENCH_STOPWORDS = {
+    "alors", "aussi", "autre", "avant", "avec", "avoir", "cette", "chaque", "comme",
+    "dans", "depuis", "donc", "elles", "encore", "entre", "être", "faire", "leurs",
+    "mais", "même", "monde", "parce", "pendant", "plus", "pour", "quand", "sans",
+    "sera", "seras", "sont", "sous", "tous", "toujours", "tout", "toute", "toutes",
+    "vers", "viendra", "vive", "chaos", "votre", "vous", "parfois", "jamais",
+}
+
+
+def _minhash_parameters():
+    """Permutations (a, b) déterministes : les signatures restent valides après un redémarrage"""
+    rng = random.Random(42)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+
+
+MINHASH_PARAMETERS = _minhash_parameters()
+
+
+def text_words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def text_shingles(text):
+    """Ensemble des groupes de SHINGLE_SIZE mots consécutifs"""
+    words = text_words(text)
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash_signature(text):
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for shingle in text_shingles(text)
+    ]
+    return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PARAMETERS]
+
+
+class ChaosHistory:
+    """Historique complet des textes générés, indexé pour retrouver les quasi-doublons"""
+
+    def __init__(self, path):
+        self.path = path
+        self.signatures = []
+        self.buckets = {}  # {(bande, valeurs): [indices]}
+        self.themes = Counter()  # Mots de contenu les plus utilisés
+        self.recent = deque(maxlen=3)  # Débuts des derniers textes
+        self.rejected = 0
+        self.offset = 0  # Fichier lu jusqu'ici (les autres processus y ajoutent leurs textes)
+        self.own = set()  # Lignes écrites par ce processus, déjà indexées
+
+    def _index(self, signature, words, preview):
+        position = len(self.signatures)
+        self.signatures.append(signature)
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        for band in range(LSH_BANDS):
+            key = (band, tuple(signature[band * rows:(band + 1) * rows]))
+            self.buckets.setdefault(key, []).append(position)
+        self.themes.update(words)
+        self.recent.append(preview)
+
+    @staticmethod
+    def _content_words(text):
+        return sorted({w for w in text_words(text) if len(w) >= 5 and w not in FRENCH_STOPWORDS})
+
+    @staticmethod
+    def _preview(text):
+        text = re.sub(r"^\s*Vive le chaos\s*!?\s*", "", text.strip(), flags=re.IGNORECASE)
+        return text[:80]
+
+    def load(self):
+        """Recharge l'historique depuis le disque (au démarrage)"""
+        self.index_items(self.read_new_sync())
+
+    def read_new_sync(self):
+        """Lit les lignes ajoutées au fichier depuis la dernière lecture (hors lignes de ce processus)"""
+        items = []
+        if not os.path.exists(self.path):
+            return items
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # Ligne en cours d'écriture par un autre processus
+                self.offset += len(raw)
+                line = raw.decode("utf-8", errors="replace").rstrip("\n")
+                if line in self.own:
+                    self.own.discard(line)
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    continue
+        return items
+
+    def index_items(self, items):
+        for item in items:
+            try:
+                self._index(item["signature"], item.get("words", []), item.get("preview", ""))
+            except (KeyError, TypeError):
+                continue
+
+    def most_similar(self, text):
+        """Similarité estimée avec le texte le plus proche de l'historique (0.0 à 1.0)"""
+        signature = minhash_signature(text)
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        candidates = set()
+        for band in range(LSH_BANDS):
+            candidates.update(self.buckets.get((band, tuple(signature[band * rows:(band + 1) * rows])), ()))
+        best = 0.0
+        for position in candidates:
+            other = self.signatures[position]
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / MINHASH_PERMUTATIONS
+            best = max(best, similarity)
+        return best
+
+    def is_near_duplicate(self, text):
+        return self.most_similar(text) >= NEAR_DUPLICATE_THRESHOLD
+
+    def add(self, text):
+        """Ajoute un texte à l'index et l'écrit à la fin du fichier d'historique"""
+        signature = minhash_signature(text)
+        words = self._content_words(text)
+        preview = self._preview(text)
+        self._index(signature, words, preview)
+        return json.dumps({"signature": signature, "words": words, "preview": preview}, ensure_ascii=False)
+
+    def append_line_sync(self, line):
+        self.own.add(line)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def summary(self):
+        """Résumé de taille constante pour le prompt, quelle que soit la taille de l'historique"""
+        if not self.signatures:
+            return "(Aucun texte précédent)"
+        themes = ", ".join(word for word, _ in self.themes.most_common(20))
+        recent = "\n".join(f"- {preview}…" for preview in self.recent)
+        return f"""Thèmes déjà très utilisés (à éviter) : {themes}
+Débuts des derniers textes :
+{recent}"""
+
+
+chaos_history = ChaosHistory(HISTORY_FILE)
+history_lock = asyncio.Lock()  # Une seule relecture du fichier à la fois
+
+
+async def sync_history():
+    """Mode partagé : indexe les textes ajoutés à l'historique par les autres processus"""
+    if shared_coordinator is None:
+        return
+    loop = asyncio.get_running_loop()
+    async with history_lock:
+        items = await loop.run_in_executor(None, chaos_history.read_new_sync)
+        chaos_history.index_items(items)
+
+
+async def remember_chaos_text(chaos_text):
+    """Enregistre un texte accepté dans l'historique (index + fichier)"""
+    line = chaos_history.add(chaos_text)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, chaos_history.append_line_sync, line)
+
+
+def is_valid_chaos_text(chaos_text):
+    """Vérifie qu'un paragraphe reçu en lot respecte le format attendu"""
+    chaos_text = chaos_text.strip()
+    return (
+        CHAOS_TEXT_MIN_LENGTH <= len(chaos_text) <= CHAOS_TEXT_MAX_LENGTH
+        and chaos_text.lower().startswith("vive le chaos")
+    )
+
+
+async def generate_unique_chaos_texts(count, label=""):
+    """Génère jusqu'à `count` textes inédits en une seule requête Gemini.
+    Les paragraphes invalides ou trop proches de l'historique (ou entre eux) sont écartés."""
+    global last_prompt
+    await sync_history()
+    prompt = build_chaos_batch_prompt(count)
+    last_prompt = prompt
+    print(f"🤖 {label}Génération de {count} textes en une requête Gemini...")
+    candidates = await generate_chaos_texts(prompt)
+    
+    accepted = []
+    for chaos_text in candidates[:count]:
+        chaos_text = chaos_text.strip()
+        if not is_valid_chaos_text(chaos_text):
+            print(f"⚠️ {label}Paragraphe invalide écarté ({len(chaos_text)} caractères)")
+            continue
+        # Les textes acceptés sont indexés au fur et à mesure : les doublons internes au lot sont vus
+        similarity = chaos_history.most_similar(chaos_text)
+        if similarity >= NEAR_DUPLICATE_THRESHOLD:
+            chaos_history.rejected += 1
+            print(f"♻️ {label}Texte trop proche d'un texte déjà généré ({similarity:.0%}), écarté")
+            continue
+        await remember_chaos_text(chaos_text)
+        accepted.append(chaos_text)
+    
+    print(f"✅ {label}{len(accepted)}/{count} textes retenus")
+    return accepted
+
+
+async def generate_unique_chaos_text(max_attempts=MAX_TEXT_ATTEMPTS, label="", accept_duplicate=False):
+    """Génère un texte avec Gemini en rejetant les quasi-doublons de l'historique.
+    Si accept_duplicate est vrai, le dernier texte est gardé même s'il ressemble à un ancien."""
+    global last_prompt
+    await sync_history()
+    chaos_text = None
+    for attempt in range(1, max_attempts + 1):
+        prompt = build_chaos_prompt()
+        last_prompt = prompt
+        print(f"🤖 {label}Génération du texte avec Gemini...")
+        chaos_text = await generate_chaos_text(prompt)
+        if not chaos_text:
+            return None
         
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            duration = float(data['format']['duration'])
-            print(f"📏 Durée audio: {duration:.2f}s")
-            return duration
-    except Exception as e:
-        print(f"⚠️ Impossible d'obtenir la durée exacte: {e}")
+        similarity = chaos_history.most_similar(chaos_text)
+        if similarity < NEAR_DUPLICATE_THRESHOLD:
+            break
+        print(f"♻️ {label}Texte trop proche d'un texte déjà généré ({similarity:.0%}), tentative {attempt}/{max_attempts}")
+        if attempt == max_attempts and accept_duplicate:
+            break
+        chaos_history.rejected += 1
+        if attempt == max_attempts:
+            return None
     
-    return None
+    await remember_chaos_text(chaos_text)
+    return chaos_text
 
-# Créer le bot
-intents = discord.Intents.default()
-intents.message_content = True
-intents.voice_states = True
-intents.guilds = True
-intents.members = True
-intents.presences = True
-bot = commands.Bot(command_prefix='!', intents=intents)
 
-# Historique des 10 dernières phrases générées
-generated_history = deque(maxlen=10)
+# ===== POOL DE CONNEXIONS VOCALES =====
 
-# Variable pour stocker le dernier prompt envoyé
-last_prompt = None
+class VoicePool:
+    """Garde les connexions vocales chaudes entre deux commandes.
+    Une connexion inutilisée pendant idle_timeout secondes est fermée."""
 
-# ===== SYSTÈME DE BUFFER DE PROMPTS PRÉ-GÉNÉRÉS =====
-# Structure: {"text": str, "tts_file": str}
-prompt_buffer = deque(maxlen=3)  # Buffer de 3 prompts prêts
-buffer_lock = asyncio.Lock()  # Lock pour éviter les race conditions
-is_generating = False  # Flag pour savoir si une génération est en cours
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.idle_tasks = {}  # {guild_id: tâche de déconnexion programmée}
+        self.hits = 0  # Connexion existante réutilisée
+        self.moves = 0  # Connexion réutilisée mais déplacée de canal
+        self.misses = 0  # Nouvelle connexion (handshake complet)
+        self.connect_times = deque(maxlen=50)  # Latences de connexion mesurées
 
-# ===== CONFIGURATION TTS =====
-# Voix disponibles: https://elevenlabs.io/docs/voices
-TTS_VOICE_ID = "iMij959nvbX8f2SxyrvX"  # Voice ID de la voix sélectionnée
-TTS_SPEED = 1.2  # Vitesse de lecture (0.5 à 2.0, défaut 1.0)
-TTS_SIMILARITY_BOOST = 1.00  # Similarity Boost (0.0 à 1.0, défaut 0.75)
-TTS_STABILITY = 1.00  # Stabilité (0.0 à 1.0, défaut 0.5)
-TTS_STYLE = 0.5  # Style (0.0 à 1.0, défaut 0.0)
-TTS_USE_SPEAKER_BOOST = True  # Utiliser speaker boost
+    def acquire(self, guild_id):
+        """Annule la déconnexion programmée : la connexion va servir"""
+        task = self.idle_tasks.pop(guild_id, None)
+        if task and not task.done():
+            task.cancel()
 
-# Dictionnaire des voix prédéfinies (exemple)
-VOICES_PRESETS = {
-    "default": "iMij959nvbX8f2SxyrvX",
-    "bella": "EXAVITQu4vr4xnSDxMaL",
-    "adam": "pNInz6obpgDQGcFmaJgB",
-    "arnold": "jBpfuIE2acIp3nSgFhAH",
-    "george": "JBFqnCBsd6RMkjW3MqDE",
-    "callum": "N2lVS1w4EtoT3dr4eOWO",
-}
+    def release(self, voice_client):
+        """Rend la connexion au pool et programme sa fermeture après inactivité"""
+        guild_id = voice_client.guild.id
+        self.acquire(guild_id)
+        delay = max(0, self.idle_timeout)
+        self.idle_tasks[guild_id] = asyncio.create_task(self._disconnect_later(voice_client, delay))
 
-# Prompt de base pour !chaos
-BASE_CHAOS_PROMPT = """Génère un paragraphe de 3 à 4 phrases, sous forme d'histoire absurde qui enchaîne des ordres étranges. Le texte doit être dérangeant, choquant, absurde, mais chaque action doit avoir une justification interne, comme si tout obéissait à une logique bizarre mais cohérente dans cet univers.
-Le ton doit être sérieux, comme si tu donnais des instructions vitales.
+    async def _disconnect_later(self, voice_client, delay):
+        try:
+            await asyncio.sleep(delay)
+            if voice_client.is_connected() and not voice_client.is_playing():
+                await voice_client.disconnect()
+                print(f"👋 Bot déconnecté du canal vocal (inactif depuis {delay:.0f}s)")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.idle_tasks.get(voice_client.guild.id) is asyncio.current_task():
+                del self.idle_tasks[voice_client.guild.id]
 
-Les phrases doivent être courtes, directes, non poétiques, et chaque phrase doit suivre le schéma :
-ordre absurde + justification étrange mais logique dans ce monde.
+    def record_connect(self, seconds):
+        self.misses += 1
+        self.connect_times.append(seconds)
 
-Voici le style exact à imiter :
-« Vive le chaos. Esport, paris sportifs, twitch, casinos en ligne = arnaque, match fixé. Salut, l'enfer n'existe pas, n'aie pas peur de la mort et tu seras plus fort. Ouvre ton robinet tous les soirs et ne l'éteins jamais. Ajoute de l'eau de javel à la nourriture et jette-la dans la foret et dans la mer avec le plastique. L'argent viendra. Je détruis le monde, tu peux m'aider en faisant ces quelques actions énoncées au-dessus. »
+    def average_connect_time(self):
+        if not self.connect_times:
+            return None
+        return sum(self.connect_times) / len(self.connect_times)
 
-Respecte ce ton, cette structure, et cette logique absurde mais cohérente. Pas de descriptions poétiques, pas de métaphores longues, juste des ordres étranges + explications étranges.
+    def saved_seconds(self):
+        """Temps de connexion économisé grâce aux connexions réutilisées (estimation)"""
+        average = self.average_connect_time()
+        return (self.hits + self.moves) * average if average else 0.0
 
-IMPORTANT: Les phrases suivantes ont DÉJÀ été générées. Tu DOIS absolument éviter de les reproduire ou de générer quelque chose de similaire. Crée quelque chose de complètement différent :
-{history}
 
-Ne me fait pas de liste, ne numérote pas les phrases, ne les sépare pas par des tirets. Écris simplement le paragraphe avec les phrases à la suite les unes des autres.
-Et commence le paragraphe par "Vive le chaos !".
-"""
+voice_pool = VoicePool(VOICE_IDLE_TIMEOUT)
 
-def build_chaos_prompt():
-    """Construit le prompt en incluant l'historique"""
-    if generated_history:
-        history_text = "\n".join(f"- {text}" for text in generated_history)
-    else:
-        history_text = "(Aucune phrase précédente)"
-    
-    return BASE_CHAOS_PROMPT.format(history=history_text)
 
 async def ensure_voice_connection(ctx):
     """S'assure que le bot est connecté au canal vocal de l'utilisateur.
-    Retourne le voice client ou None."""
+    Réutilise la connexion du pool si possible. Retourne le voice client ou None."""
     
     if ctx.author.voice is None or ctx.author.voice.channel is None:
         await ctx.send("❌ Tu dois être dans un canal vocal !")
         return None
     
     voice_channel = ctx.author.voice.channel
+    voice_pool.acquire(ctx.guild.id)
     
     # Vérifier s'il y a une connexion existante
     voice_client = discord.utils.get(bot.voice_clients, guild=ctx.guild)
@@ -164,299 +1841,1530 @@ async def ensure_voice_connection(ctx):
     if voice_client and voice_client.is_connected():
         # Si on est dans le bon canal, garder la connexion
         if voice_client.channel == voice_channel:
+            voice_pool.hits += 1
+            metrics.inc("voice_connections_total", result="reused")
+            print("♻️ Connexion vocale réutilisée")
             return voice_client
         # Sinon, se déplacer vers le nouveau canal
         else:
-            await voice_client.move_to(voice_channel)
+            with metrics.timer("voice_move_seconds"):
+                await voice_client.move_to(voice_channel)
+            voice_pool.moves += 1
+            metrics.inc("voice_connections_total", result="moved")
             return voice_client
     
     # Se connecter pour la première fois
     try:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
         voice_client = await voice_channel.connect(timeout=60, reconnect=True, self_deaf=True)
+        voice_pool.record_connect(loop.time() - started)
+        metrics.observe("voice_connect_seconds", loop.time() - started)
+        metrics.inc("voice_connections_total", result="connected")
+        print(f"🔌 Nouvelle connexion vocale ({loop.time() - started:.2f}s)")
         return voice_client
     except Exception as e:
+        metrics.inc("voice_connections_total", result="error")
         print(f"Erreur connexion vocale: {e}")
         await ctx.send(f"❌ Erreur de connexion vocale: {e}")
         return None
 
-async def play_audio_file(voice_client, audio_file="kaamelott.mp3"):
+async def play_and_wait(voice_client, audio_source, timeout=None, on_start=None):
+    """Lance la lecture et attend le callback after= de discord.py (pas de sleep ni de polling).
+    on_start est appelé juste après le lancement de la lecture (mesure du temps de réponse).
+    Retourne True si la lecture s'est terminée sans erreur."""
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    
+    def resolve(error):
+        if not finished.done():
+            finished.set_result(error)
+    
+    def after(error):
+        # Appelé depuis le thread audio de discord.py
+        loop.call_soon_threadsafe(resolve, error)
+    
+    voice_client.play(audio_source, after=after)
+    if on_start:
+        on_start()
+    
+    try:
+        error = await asyncio.wait_for(finished, timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Lecture toujours en cours après {timeout:.1f}s, arrêt forcé")
+        voice_client.stop()
+        return False
+    
+    if error:
+        print(f"❌ Erreur pendant la lecture: {error}")
+        return False
+    return True
+
+
+def playback_timeout(duration, default=120):
+    """Délai de garde pour une lecture de durée connue (ou non)"""
+    return duration + 5 if duration else default
+
+
+async def play_audio_file(voice_client, audio_file="kaamelott.mp3", on_start=None):
     """Joue un fichier audio sans déconnecter"""
     
+    # Clip déjà décodé en mémoire : ni ffprobe ni FFmpeg
+    clip = static_clips.get(audio_file)
+    if clip:
+        try:
+            return await play_and_wait(voice_client, clip.source(), playback_timeout(clip.duration), on_start)
+        except Exception as e:
+            print(f"Erreur lecture audio: {e}")
+            return False
+    
     if not os.path.exists(audio_file):
         print(f"Fichier non trouvé: {audio_file}")
         return False
     
     try:
-        # Obtenir la durée exacte du fichier
-        duration = get_audio_duration(audio_file)
+        # Durée lue dans les en-têtes MP3 (uniquement pour le délai de garde)
+        loop = asyncio.get_running_loop()
+        duration = await loop.run_in_executor(None, get_audio_duration, audio_file)
         
         audio_source = discord.FFmpegPCMAudio(audio_file)
-        voice_client.play(audio_source)
-        
-        # Attendre la fin avec la durée exacte si disponible
-        if duration:
-            await asyncio.sleep(duration + 0.3)  # +0.3s de marge
-        else:
-            # Fallback sur la méthode is_playing()
-            while voice_client.is_playing():
-                await asyncio.sleep(0.1)
-            await asyncio.sleep(0.3)
-        
-        return True
+        return await play_and_wait(voice_client, audio_source, playback_timeout(duration), on_start)
         
     except Exception as e:
         print(f"Erreur lecture audio: {e}")
         return False
 
-def generate_tts_file_sync(text, retry_on_quota=True):
-    """Génère un fichier TTS avec ElevenLabs (fonction synchrone pour run_in_executor)
+def current_voice_settings(settings):
+    """Construit les voice_settings ElevenLabs à partir d'un relevé de current_tts_settings()"""
+    return {
+        "stability": settings["TTS_STABILITY"],
+        "similarity_boost": settings["TTS_SIMILARITY_BOOST"],
+        "style": settings["TTS_STYLE"],
+        "use_speaker_boost": settings["TTS_USE_SPEAKER_BOOST"],
+        "speed": settings["TTS_SPEED"],
+    }
+
+
+# Paramètres de voix modifiables par commande (communs à tous les processus en mode partagé)
+TTS_SETTINGS = ("TTS_VOICE_ID", "TTS_SPEED", "TTS_SIMILARITY_BOOST", "TTS_STABILITY", "TTS_STYLE", "TTS_USE_SPEAKER_BOOST")
+
+
+def current_tts_settings():
+    return {name: globals()[name] for name in TTS_SETTINGS}
+
+
+def apply_tts_settings(settings):
+    """Applique des paramètres lus dans le store partagé. Retourne True si quelque chose a changé."""
+    changed = False
+    for name in TTS_SETTINGS:
+        if name in settings and globals()[name] != settings[name]:
+            globals()[name] = settings[name]
+            changed = True
+    return changed
+
+
+def tts_fingerprint(settings=None):
+    """Empreinte des paramètres de voix (actuels ou relevé de current_tts_settings()) :
+    deux audios de même empreinte sonnent pareil"""
+    settings = settings or current_tts_settings()
+    values = [
+        settings["TTS_VOICE_ID"], TTS_MODEL_ID, TTS_OUTPUT_FORMAT, settings["TTS_STABILITY"],
+        settings["TTS_SIMILARITY_BOOST"], settings["TTS_STYLE"], settings["TTS_USE_SPEAKER_BOOST"], settings["TTS_SPEED"],
+    ]
+    return hashlib.sha1(json.dumps(values).encode()).hexdigest()[:12]
+
+
+def is_quota_error(error):
+    """Vrai si l'erreur ElevenLabs correspond à un quota dépassé"""
+    error_str = str(error)
+    return "quota_exceeded" in error_str or "quota" in error_str.lower()
+
+
+def is_key_health_error(error):
+    """Erreur imputable à la clé (quota, authentification, rate limit) : la clé est mise en
+    pause et la requête réessayée sur une autre. Les autres erreurs (requête invalide, réseau,
+    panne du service) concernent la requête : changer de clé n'y changerait rien."""
+    if is_quota_error(error):
+        return True
+    return isinstance(error, ProviderError) and error.status in (401, 429)
+
+
+async def synthesize_tts(text, on_chunk=None, retry_on_quota=True, previous_text=None, next_text=None, settings=None):
+    """Synthétise un texte avec ElevenLabs et retourne l'audio MP3 complet (ou None).
+    on_chunk est appelé pour chaque chunk reçu (streaming)."""
+    settings = settings or current_tts_settings()
+    # Au plus une tentative par clé
+    attempts = len(elevenlabs_keys.keys) if retry_on_quota else 1
+    streamed = 0
+    for _ in range(attempts):
+        key = await elevenlabs_keys.acquire(len(text))
+        if key is None:
+            return None
+        
+        chunks = []
+        error = None
+        started = time.perf_counter()
+        try:
+            print(f"🎤 Génération TTS avec ElevenLabs [{key.label}] (vitesse: {settings['TTS_SPEED']}, stabilité: {settings['TTS_STABILITY']})...")
+            async for chunk in providers.elevenlabs_stream(key.api_key, text, previous_text, next_text, settings):
+                if not chunks:
+                    metrics.observe("elevenlabs_first_chunk_seconds", time.perf_counter() - started)
+                chunks.append(chunk)
+                streamed += len(chunk)
+                if on_chunk:
+                    on_chunk(chunk)
+            if not chunks:
+                raise ProviderError("ElevenLabs", 200, "réponse audio vide")
+        except asyncio.CancelledError:
+            # Annulation (lecture abandonnée) : la clé n'est pas en cause
+            await elevenlabs_keys.release(key, characters=len(text))
+            raise
+        except Exception as e:
+            error = e
+        
+        if error is None:
+            metrics.observe("elevenlabs_request_seconds", time.perf_counter() - started)
+            await elevenlabs_keys.release(key, characters=len(text))
+            print(f"✅ TTS: {len(chunks)} chunks reçus")
+            return b"".join(chunks)
+        
+        print(f"❌ Erreur génération TTS: {type(error).__name__}: {error}")
+        await elevenlabs_keys.release(key, error=error)
+        # Requête invalide (voix inconnue...), réseau ou panne ElevenLabs : aucune clé n'y changera rien
+        if not is_key_health_error(error):
+            raise error
+        # On ne peut changer de clé que si rien n'a encore été envoyé au lecteur
+        if streamed:
+            return None
+        metrics.inc("elevenlabs_key_rotations_total")
+        print("⚠️ Clé en pause, nouvelle tentative avec une autre clé...")
+    
+    print("❌ Plus de clés disponibles !")
+    return None
+
+
+def split_tts_segments(text, min_length=TTS_SEGMENT_MIN_LENGTH):
+    """Découpe un texte en phrases. La première est toujours seule (son audio arrive
+    plus vite), les suivantes sont regroupées jusqu'à min_length caractères."""
+    sentences = [sentence for sentence in re.split(r'(?<=[.!?…])\s+', text.strip()) if sentence]
+    segments = sentences[:1]
+    rest = []
+    for sentence in sentences[1:]:
+        if rest and len(rest[-1]) < min_length:
+            rest[-1] = f"{rest[-1]} {sentence}"
+        else:
+            rest.append(sentence)
+    # Une dernière phrase trop courte rejoint la précédente
+    if len(rest) > 1 and len(rest[-1]) < min_length:
+        rest[-2:] = [f"{rest[-2]} {rest[-1]}"]
+    return segments + rest
+
+
+async def synthesize_tts_parallel(text, on_chunk=None, settings=None):
+    """Synthétise les phrases d'un texte en parallèle (dans la limite des clés) et les raccorde.
+    La première phrase est transmise à on_chunk dès réception, les suivantes dans l'ordre
+    dès qu'elles sont prêtes. Retourne le MP3 complet (ou None).
+    Tous les segments utilisent les mêmes paramètres de voix (`settings`), même si une
+    commande les modifie pendant la synthèse."""
+    settings = settings or current_tts_settings()
+    segments = split_tts_segments(text) if TTS_SENTENCE_PARALLEL else [text]
+    if len(segments) <= 1:
+        return await synthesize_tts(text, on_chunk=on_chunk, settings=settings)
     
-    Args:
-        text: Le texte à convertir en audio
-        retry_on_quota: Si True, essaie de changer de clé API en cas de quota dépassé
-    """
-    temp_file = None
+    print(f"✂️ TTS découpé en {len(segments)} segments synthétisés en parallèle")
+    metrics.inc("tts_segments_total", len(segments))
+    
+    def context(i):
+        previous_text = segments[i - 1] if i > 0 else None
+        next_text = segments[i + 1] if i + 1 < len(segments) else None
+        return previous_text, next_text
     
+    # Les segments suivants partent tout de suite ; le premier est diffusé en direct
+    tasks = [asyncio.create_task(synthesize_tts(segment, None, True, *context(i), settings=settings))
+             for i, segment in enumerate(segments[1:], start=1)]
     try:
-        print(f"🎤 Génération TTS avec ElevenLabs [{get_current_key_info()}] (vitesse: {TTS_SPEED}, stabilité: {TTS_STABILITY})...")
-        audio = elevenlabs_client.text_to_speech.convert(
-            text=text,
-            voice_id=TTS_VOICE_ID,
-            model_id="eleven_multilingual_v2",
-            output_format="mp3_44100_128",
-            voice_settings=VoiceSettings(
-                stability=TTS_STABILITY,
-                similarity_boost=TTS_SIMILARITY_BOOST,
-                style=TTS_STYLE,
-                use_speaker_boost=TTS_USE_SPEAKER_BOOST,
-                speed=TTS_SPEED,
-            ),
-        )
+        first = await synthesize_tts(segments[0], on_chunk, True, *context(0), settings=settings)
+        if not first:
+            return None
+        parts = [first]
+        for task in tasks:
+            data = await task
+            if not data:
+                print("❌ Segment TTS manquant, synthèse abandonnée")
+                return None
+            # Raccord sans en-têtes intermédiaires : un seul flux MP3 continu pour FFmpeg
+            payload = mp3_audio_payload(data)
+            if on_chunk:
+                on_chunk(payload)
+            parts.append(payload)
+        return b"".join(parts)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # Erreur d'un segment abandonné : déjà journalisée
+
+
+def write_tts_file_sync(data, directory=None):
+    """Écrit un audio TTS dans un nouveau fichier de `directory` (fonction synchrone pour run_in_executor)"""
+    with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False, dir=directory) as tmp:
+        tmp.write(data)
+        return tmp.name
+
+
+async def generate_tts_audio(text):
+    """Génère l'audio TTS d'un texte avec ElevenLabs (ou depuis le cache).
+    Retourne le MP3 en mémoire, ou None."""
+    loop = asyncio.get_running_loop()
+    
+    # Même texte + mêmes paramètres déjà synthétisés : pas d'appel ElevenLabs.
+    # Paramètres figés ici : l'audio mis en cache correspond toujours à sa clé
+    settings = current_tts_settings()
+    cache_key = tts_cache.key(text, tts_fingerprint(settings))
+    cached_data = await loop.run_in_executor(None, tts_cache.get_bytes, cache_key)
+    if cached_data:
+        print(f"💾 TTS trouvé dans le cache ({cache_key[:12]})")
+        return cached_data
+    
+    data = await synthesize_tts_parallel(text, settings=settings)
+    if not data:
+        return None
+    
+    await loop.run_in_executor(None, tts_cache.put_bytes, cache_key, data)
+    print(f"✅ Audio TTS prêt ({len(data)} bytes)")
+    return data
+
+
+async def play_tts_audio(voice_client, audio, on_start=None):
+    """Joue un audio TTS de l'AudioStore (la référence reste à l'appelant)"""
+    try:
+        if not voice_client or not voice_client.is_connected():
+            print("❌ Le bot n'est pas connecté au canal vocal")
+            return False
         
-        # Sauvegarder dans un fichier temporaire
-        with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp:
-            temp_file = tmp.name
-            chunks_written = 0
-            for chunk in audio:
-                tmp.write(chunk)
-                chunks_written += 1
-            print(f"✅ TTS: {chunks_written} chunks écrits")
+        loop = asyncio.get_running_loop()
+        data, packets = await audio.read()
+        if packets:
+            # Paquets Opus pré-encodés : envoyés tels quels, sans FFmpeg ni encodage
+            print(f"🔊 Lecture du TTS pré-encodé ({len(packets)} paquets Opus)...")
+            duration = len(packets) * OPUS_FRAME_DURATION
+            audio_source = OpusPacketAudio(packets)
+        else:
+            print(f"🔊 Lecture du TTS ({len(data)} bytes)...")
+            # Durée lue dans les en-têtes MP3 (uniquement pour le délai de garde)
+            duration = await loop.run_in_executor(None, mp3_duration, data)
+            audio_source = discord.FFmpegPCMAudio(io.BytesIO(data), pipe=True)
         
-        if not os.path.exists(temp_file) or os.path.getsize(temp_file) == 0:
-            print("❌ Le fichier TTS est vide ou n'existe pas")
-            return None
+        if not await play_and_wait(voice_client, audio_source, playback_timeout(duration), on_start):
+            return False
         
-        print(f"✅ Fichier TTS prêt ({os.path.getsize(temp_file)} bytes)")
-        return temp_file
+        print("✅ Lecture TTS terminée")
+        return True
         
     except Exception as e:
-        error_str = str(e)
-        print(f"❌ Erreur génération TTS: {type(e).__name__}: {e}")
-        
-        # Vérifier si c'est une erreur de quota
-        if retry_on_quota and ("quota_exceeded" in error_str or "quota" in error_str.lower()):
-            print("⚠️ Quota dépassé, tentative de rotation de clé...")
-            
-            # Nettoyer le fichier temporaire si créé
-            if temp_file and os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
-            
-            # Essayer de changer de clé
-            if rotate_elevenlabs_key():
-                print("🔄 Nouvelle clé activée, nouvelle tentative...")
-                return generate_tts_file_sync(text, retry_on_quota=True)
-            else:
-                print("❌ Plus de clés disponibles !")
+        print(f"❌ Erreur lecture TTS: {type(e).__name__}: {e}")
+        return False
+
+
+# ===== CACHE TTS =====
+
+class TTSCache:
+    """Cache disque des audios TTS, adressé par le contenu (texte + empreinte des paramètres).
+    Éviction LRU par taille totale et par âge. Utilisé depuis les threads de l'executor."""
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {clé: [taille, dernier accès]}, du plus ancien au plus récent
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(text, fingerprint):
+        return hashlib.sha256(f"{fingerprint}\0{text}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".mp3")
+
+    def _scan(self):
+        """Reconstruit l'index LRU à partir des fichiers présents"""
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mp3"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            found.append((stat.st_mtime, name[:-4], stat.st_size))
+        for last_used, key, size in sorted(found):
+            self.entries[key] = [size, last_used]
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    def _touch(self, key):
+        entry = self.entries.get(key)
+        if entry is None or not os.path.exists(self._path(key)):
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return False
+        entry[1] = time.time()
+        self.entries.move_to_end(key)
+        try:
+            os.utime(self._path(key))  # L'ordre LRU survit au redémarrage
+        except OSError:
+            pass
+        self.hits += 1
+        return True
+
+    def get_bytes(self, key):
+        """Retourne le contenu en cache, ou None"""
+        with self.lock:
+            if not self._touch(key):
                 return None
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+
+    def put_bytes(self, key, data):
+        """Ajoute un audio au cache (écriture atomique)"""
+        if not data:
+            return
+        with self.lock:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            if key in self.entries:
+                self.total_bytes -= self.entries[key][0]
+            self.entries[key] = [len(data), time.time()]
+            self.entries.move_to_end(key)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def _drop(self, key):
+        size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Supprime les entrées trop vieilles puis les moins récemment utilisées"""
+        now = time.time()
+        for key, (size, last_used) in list(self.entries.items()):
+            if now - last_used <= self.max_age:
+                break  # Les suivantes sont plus récentes
+            self._drop(key)
+            self.evictions += 1
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_CACHE_MAX_AGE)
+
+
+# ===== STOCKAGE AUDIO EN MÉMOIRE =====
+
+class AudioHandle:
+    """Audio TTS (MP3 + paquets Opus éventuels) géré par l'AudioStore.
+    Compté par références : le dernier release() libère la mémoire et supprime les fichiers."""
+
+    def __init__(self, store, data=None, packets=None, path=None, size=None):
+        self.id = next(store.ids)
+        self.store = store
+        self.data = data
+        self.packets = packets
+        self.size = size if size is not None else len(data)
+        self.refs = 1
+        self.files = []  # MP3 sur disque (copie durable ou débordement), paquets Opus à côté
+        self.path = None
+        if path:
+            self.attach_path(path)
+        # Filet de sécurité : un handle perdu sans release() ne laisse ni mémoire ni fichier.
+        # Pas à la sortie du processus : le spool doit survivre au redémarrage.
+        self.finalizer = weakref.finalize(self, store.collect, self.id, self.files)
+        self.finalizer.atexit = False
+
+    def memory_bytes(self):
+        total = len(self.data) if self.data is not None else 0
+        if self.packets:
+            total += sum(len(packet) for packet in self.packets)
+        return total
+
+    def attach_path(self, path):
+        self.path = path
+        self.files.append(path)
+
+    def retain(self):
+        self.refs += 1
+        return self
+
+    async def release(self):
+        self.refs -= 1
+        if self.refs == 0:
+            await self.store.free(self)
+
+    async def read(self):
+        """Retourne (mp3, paquets Opus ou None), depuis la mémoire ou le disque"""
+        self.store.touch(self)
+        if self.data is not None:
+            return self.data, self.packets
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, read_audio_files_sync, self.path)
+
+
+def read_audio_files_sync(path):
+    """Relit un audio déplacé sur disque : MP3 et paquets Opus s'ils existent"""
+    with open(path, "rb") as f:
+        data = f.read()
+    opus_file = opus_sidecar(path)
+    packets = read_opus_packets_sync(opus_file) if os.path.exists(opus_file) else None
+    return data, packets
+
+
+def write_audio_files_sync(directory, data, packets=None):
+    """Écrit un audio (et ses paquets Opus) sur disque. Retourne le chemin du MP3."""
+    path = write_tts_file_sync(data, directory)
+    if packets:
+        write_opus_packets_sync(opus_sidecar(path), packets)
+    return path
+
+
+class AudioStore:
+    """Audios prêts à jouer, en mémoire sous un budget global d'octets.
+    Au-delà du budget, les moins récemment utilisés passent sur disque (SPOOL_DIR : le
+    ménage du spool au démarrage supprime ce qu'un crash aurait laissé)."""
+
+    def __init__(self, max_bytes, directory):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.ids = itertools.count(1)
+        self.resident = OrderedDict()  # {id: (weakref du handle, octets)}, du plus ancien au plus récent
+        self.memory_bytes = 0
+        self.live = 0
+        self.spills = 0
+        self.leaks = 0  # Handles ramassés par le GC sans release()
+
+    async def put(self, data, packets=None, path=None):
+        """Ajoute un audio en mémoire et retourne son handle (une référence)"""
+        handle = AudioHandle(self, data, packets, path)
+        self.live += 1
+        self._make_resident(handle)
+        await self.enforce_budget()
+        return handle
+
+    def adopt(self, path, size):
+        """Handle pour un audio déjà sur disque (spool rechargé au démarrage)"""
+        handle = AudioHandle(self, path=path, size=size)
+        self.live += 1
+        return handle
+
+    async def warm(self, handle):
+        """Recharge en mémoire un audio sur disque, si le budget le permet"""
+        if handle.data is not None or handle.refs <= 0 or self.memory_bytes + handle.size > self.max_bytes:
+            return
+        data, packets = await handle.read()
+        if handle.refs > 0 and handle.data is None:
+            handle.data, handle.packets = data, packets
+            self._make_resident(handle)
+
+    def _make_resident(self, handle):
+        size = handle.memory_bytes()
+        self.resident[handle.id] = (weakref.ref(handle), size)
+        self.memory_bytes += size
+
+    def _evict_resident(self, handle_id):
+        _, size = self.resident.pop(handle_id, (None, 0))
+        self.memory_bytes -= size
+
+    def touch(self, handle):
+        if handle.id in self.resident:
+            self.resident.move_to_end(handle.id)
+
+    async def enforce_budget(self):
+        """Déplace sur disque les audios les moins récemment utilisés jusqu'à respecter le budget"""
+        loop = asyncio.get_running_loop()
+        while self.memory_bytes > self.max_bytes and self.resident:
+            handle_id, (ref, _) = next(iter(self.resident.items()))
+            handle = ref()
+            self._evict_resident(handle_id)
+            if handle is None or handle.data is None:
+                continue
+            data, packets = handle.data, handle.packets
+            if handle.path is None:
+                path = await loop.run_in_executor(None, write_audio_files_sync, self.directory, data, packets)
+                if handle.refs <= 0:  # Libéré pendant l'écriture
+                    await loop.run_in_executor(None, remove_tts_file_sync, path)
+                    continue
+                handle.attach_path(path)
+                self.spills += 1
+            handle.data = handle.packets = None
+
+    async def free(self, handle):
+        """Dernière référence rendue : mémoire et fichiers libérés"""
+        handle.finalizer.detach()
+        self._evict_resident(handle.id)
+        handle.data = handle.packets = None
+        self.live -= 1
+        if handle.files:
+            loop = asyncio.get_running_loop()
+            for path in handle.files:
+                await loop.run_in_executor(None, remove_tts_file_sync, path)
+
+    def collect(self, handle_id, files):
+        """Appelé par le GC pour un handle jamais rendu"""
+        self._evict_resident(handle_id)
+        self.live -= 1
+        self.leaks += 1
+        for path in files:
+            remove_tts_file_sync(path)
+
+
+audio_store = AudioStore(AUDIO_STORE_MAX_BYTES, SPOOL_DIR)
+
+
+# ===== STREAMING TTS =====
+
+class TTSStream(io.RawIOBase):
+    """Flux TTS lu par FFmpeg via son stdin (pipe=True).
+    Les chunks ElevenLabs sont transmis dès leur arrivée, sans fichier temporaire."""
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.chunks = queue.Queue()
+        self.pending = b""
+        self.eof = False
+        self.cancelled = False
+        self.error = None
+        self.bytes_received = 0
+        self.first_chunk = loop.create_future()  # Résolu au premier chunk (ou à la fin)
+        self.task = None  # Tâche de synthèse qui alimente le flux
+
+    # --- Côté producteur (tâche de synthèse) ---
+
+    def _signal_first_chunk(self):
+        def resolve():
+            if not self.first_chunk.done():
+                self.first_chunk.set_result(self.bytes_received > 0)
+        self.loop.call_soon_threadsafe(resolve)
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        first = self.bytes_received == 0
+        self.bytes_received += len(chunk)
+        self.chunks.put(chunk)
+        if first:
+            self._signal_first_chunk()
+
+    def finish(self, error=None):
+        self.error = error
+        self.chunks.put(None)
+        self._signal_first_chunk()
+
+    def cancel(self):
+        """Abandonne le flux (connexion vocale échouée, lecture interrompue...)"""
+        self.cancelled = True
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.chunks.put(None)
+
+    # --- Côté consommateur (thread d'écriture de FFmpeg) ---
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self.pending and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.pending = chunk
+
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+async def stream_tts(text, stream):
+    """Envoie les chunks ElevenLabs dans le flux au fur et à mesure"""
+    loop = asyncio.get_running_loop()
+    settings = current_tts_settings()
+    cache_key = tts_cache.key(text, tts_fingerprint(settings))
+    try:
+        cached_data = await loop.run_in_executor(None, tts_cache.get_bytes, cache_key)
+        if cached_data:
+            print(f"💾 TTS trouvé dans le cache ({cache_key[:12]})")
+            for i in range(0, len(cached_data), 16384):
+                stream.feed(cached_data[i:i + 16384])
+            stream.finish()
+            return
         
-        import traceback
-        traceback.print_exc()
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-        return None
+        data = await synthesize_tts_parallel(text, on_chunk=stream.feed, settings=settings)
+        if not data:
+            stream.finish(error=RuntimeError("Synthèse ElevenLabs impossible"))
+            return
+        print(f"✅ Streaming TTS terminé ({stream.bytes_received} bytes)")
+        stream.finish()
+        await loop.run_in_executor(None, tts_cache.put_bytes, cache_key, data)
+    except asyncio.CancelledError:
+        print("⏹️ Streaming TTS annulé")
+        stream.finish(error=RuntimeError("Streaming annulé"))
+    except Exception as e:
+        print(f"❌ Erreur streaming TTS: {type(e).__name__}: {e}")
+        stream.finish(error=e)
 
 
-async def generate_tts_file(text):
-    """Génère un fichier TTS avec ElevenLabs (async wrapper)"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, generate_tts_file_sync, text)
+def start_tts_stream(text):
+    """Démarre la synthèse en streaming en arrière-plan et retourne le flux"""
+    stream = TTSStream(asyncio.get_running_loop())
+    stream.task = asyncio.create_task(stream_tts(text, stream))
+    return stream
 
 
-async def play_tts_file(voice_client, tts_file, delete_after=True):
-    """Joue un fichier TTS déjà généré"""
+async def play_tts_stream(voice_client, stream, first_chunk_timeout=30, on_start=None):
+    """Joue un flux TTS dès que le premier chunk est arrivé"""
     try:
         if not voice_client or not voice_client.is_connected():
             print("❌ Le bot n'est pas connecté au canal vocal")
+            stream.cancel()
             return False
         
-        if not tts_file or not os.path.exists(tts_file):
-            print("❌ Le fichier TTS n'existe pas")
+        # Attendre le premier chunk : FFmpeg n'a rien à décoder avant
+        with metrics.timer("tts_stream_first_chunk_wait_seconds"):
+            has_audio = await asyncio.wait_for(asyncio.shield(stream.first_chunk), timeout=first_chunk_timeout)
+        if not has_audio:
+            print(f"❌ Aucun audio reçu d'ElevenLabs ({stream.error})")
             return False
         
-        file_size = os.path.getsize(tts_file)
-        print(f"🔊 Lecture du fichier TTS ({file_size} bytes)...")
-        
-        # Obtenir la durée exacte du fichier
-        duration = get_audio_duration(tts_file)
-        
-        audio_source = discord.FFmpegPCMAudio(tts_file)
-        voice_client.play(audio_source)
-        
-        # Attendre la fin avec la durée exacte si disponible
-        if duration:
-            await asyncio.sleep(duration + 0.5)  # +0.5s de marge pour le TTS
-        else:
-            # Fallback sur la méthode is_playing() avec timeout
-            timeout = 0
-            while voice_client.is_playing() and timeout < 120:
-                await asyncio.sleep(0.1)
-                timeout += 0.1
+        print("🔊 Lecture du TTS en streaming...")
+        audio_source = discord.FFmpegPCMAudio(stream, pipe=True)
+        played = await play_and_wait(voice_client, audio_source, playback_timeout(None), on_start)
         
-        print("✅ Lecture TTS terminée")
-        return True
+        print(f"✅ Lecture TTS en streaming terminée ({stream.bytes_received} bytes)")
+        return played and stream.error is None
         
+    except asyncio.TimeoutError:
+        print("❌ Timeout en attendant le premier chunk TTS")
+        stream.cancel()
+        return False
     except Exception as e:
-        print(f"❌ Erreur lecture TTS: {type(e).__name__}: {e}")
+        print(f"❌ Erreur lecture TTS en streaming: {type(e).__name__}: {e}")
+        stream.cancel()
         return False
-    finally:
-        # Nettoyer le fichier temporaire seulement si demandé
-        if delete_after and tts_file and os.path.exists(tts_file):
+
+
+async def generate_chaos_text(prompt):
+    """Génère du texte avec Gemini"""
+    try:
+        return await providers.gemini_generate(prompt) or None
+    except Exception as e:
+        print(f"❌ Erreur Gemini: {type(e).__name__}: {e}")
+        return None
+
+
+async def generate_chaos_texts(prompt):
+    """Génère plusieurs paragraphes en une requête Gemini (réponse JSON structurée)"""
+    try:
+        raw = await providers.gemini_generate(prompt, generation_config={
+            "responseMimeType": "application/json",
+            "responseSchema": {"type": "ARRAY", "items": {"type": "STRING"}},
+        })
+        texts = json.loads(raw)
+        if not isinstance(texts, list):
+            raise ValueError("la réponse n'est pas une liste")
+        return [text for text in texts if isinstance(text, str)]
+    except Exception as e:
+        print(f"❌ Erreur Gemini (lot): {type(e).__name__}: {e}")
+        return []
+
+
+# ===== SYSTÈME DE BUFFER =====
+
+class DemandEstimator:
+    """Estime le débit de !chaos et la latence de génération pour dimensionner le buffer.
+    Cible = commandes attendues pendant une génération complète (loi de Little) + marge,
+    bornée par BUFFER_MIN_SIZE/BUFFER_MAX_SIZE et par les budgets de quota."""
+
+    def __init__(self, half_life):
+        self.tau = half_life / math.log(2)
+        self.rate = 0.0  # Commandes par seconde (moyenne mobile exponentielle)
+        self.last_event = time.monotonic()
+        self.commands = 0
+        self.generation_latency = None  # Secondes (texte + TTS), moyenne mobile
+        self.average_characters = None  # Longueur moyenne d'un texte généré
+        self.budget_day = time.strftime('%Y-%m-%d')
+        self.characters_today = 0
+
+    def current_rate(self):
+        """Débit estimé à l'instant présent (décroît en l'absence de commandes)"""
+        return self.rate * math.exp(-(time.monotonic() - self.last_event) / self.tau)
+
+    def record_command(self):
+        now = time.monotonic()
+        self.rate = self.rate * math.exp(-(now - self.last_event) / self.tau) + 1 / self.tau
+        self.last_event = now
+        self.commands += 1
+        signal_refill()  # La profondeur visée a pu augmenter
+
+    def record_generation(self, seconds, characters):
+        alpha = 0.3
+        if self.generation_latency is None:
+            self.generation_latency = seconds
+            self.average_characters = characters
+        else:
+            self.generation_latency += alpha * (seconds - self.generation_latency)
+            self.average_characters += alpha * (characters - self.average_characters)
+        self.record_characters(characters)
+
+    def record_characters(self, characters):
+        today = time.strftime('%Y-%m-%d')
+        if today != self.budget_day:
+            self.budget_day = today
+            self.characters_today = 0
+        self.characters_today += characters
+
+    def quota_limit(self):
+        """Nombre maximum d'entrées que le quota permet de garder en stock (None = pas de limite)"""
+        limits = []
+        if BUFFER_DAILY_CHARACTER_BUDGET > 0 and self.average_characters:
+            self.record_characters(0)  # Changement de jour éventuel
+            left = BUFFER_DAILY_CHARACTER_BUDGET - self.characters_today
+            limits.append(int(max(0, left) // self.average_characters))
+        now = time.time()
+        known = [k.remaining for k in elevenlabs_keys.keys
+                 if k.remaining is not None and k.cooldown_until <= now and not (k.reset_at and k.reset_at <= now)]
+        if self.average_characters and known and len(known) == len(elevenlabs_keys.keys):
+            limits.append(int(sum(known) // self.average_characters))
+        return min(limits) if limits else None
+
+    def target(self):
+        """Profondeur de buffer visée"""
+        if self.generation_latency is None or self.commands == 0:
+            target = BUFFER_DEFAULT_SIZE
+        else:
+            expected = self.current_rate() * self.generation_latency
+            target = math.ceil(expected * 1.5) + 1
+        target = max(BUFFER_MIN_SIZE, min(BUFFER_MAX_SIZE, target))
+
+        limit = self.quota_limit()
+        if limit is not None:
+            target = max(min(BUFFER_MIN_SIZE, limit), min(target, limit))
+        return target
+
+
+demand = DemandEstimator(DEMAND_HALF_LIFE)
+
+
+def buffer_target():
+    """Nombre de prompts que le buffer doit contenir en ce moment"""
+    return demand.target()
+
+
+class BufferPipeline:
+    """Producteur en deux étages (texte Gemini -> TTS ElevenLabs) reliés par des files bornées.
+    Chaque étage a sa propre concurrence : le texte de l'entrée N+1 est généré
+    pendant la synthèse vocale de l'entrée N."""
+
+    def __init__(self, text_concurrency, tts_concurrency, queue_size, batch_size=1):
+        self.text_concurrency = text_concurrency
+        self.batch_size = max(1, batch_size)
+        self.tts_concurrency = tts_concurrency
+        self.orders = asyncio.Queue()  # Une commande par entrée à produire
+        self.texts = asyncio.Queue(maxsize=queue_size)  # Textes en attente de TTS (borné)
+        self.in_flight = 0  # Entrées commandées mais pas encore dans le buffer
+        self.text_active = 0
+        self.tts_active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.consecutive_failures = 0
+        self.workers = []
+        self.stats = {"text_ok": 0, "text_errors": 0, "tts_ok": 0, "tts_errors": 0, "resynthesized": 0, "batches": 0}
+
+    def start(self):
+        """Lance les workers des deux étages (une seule fois)"""
+        if self.workers:
+            return
+        for i in range(self.text_concurrency):
+            self.workers.append(asyncio.create_task(self._text_worker(i + 1)))
+        for i in range(self.tts_concurrency):
+            self.workers.append(asyncio.create_task(self._tts_worker(i + 1)))
+        print(f"🏭 Pipeline démarré ({self.text_concurrency} worker(s) texte, {self.tts_concurrency} worker(s) TTS)")
+
+    def request(self, count):
+        """Commande `count` nouvelles entrées pour le buffer (non bloquant)"""
+        for _ in range(count):
+            self.in_flight += 1
+            self.orders.put_nowait(None)
+        if count > 0:
+            self.idle.clear()
+
+    def _finish(self, ok):
+        """Une entrée commandée est terminée (ajoutée au buffer ou abandonnée)"""
+        self.in_flight -= 1
+        if self.in_flight <= 0:
+            self.in_flight = 0
+            self.idle.set()
+        # Compteur d'échecs consécutifs : sert au backoff du superviseur
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+        signal_refill()
+
+    async def _text_worker(self, worker_id):
+        """Étage 1 : génère les textes avec Gemini (par lots si plusieurs commandes attendent)"""
+        while True:
+            await self.orders.get()
+            # Regrouper les commandes en attente : une seule requête Gemini pour tout le lot.
+            # À froid, pas de lot : les workers texte produisent en parallèle, le premier
+            # prompt arrive après une seule génération courte.
+            batch_size = self.batch_size if startup.is_ready() else 1
+            count = 1
+            while count < batch_size and not self.orders.empty():
+                self.orders.get_nowait()
+                count += 1
+
+            self.text_active += 1
+            started = time.monotonic()
+            label = f"[texte #{worker_id}] "
             try:
-                os.remove(tts_file)
-                print("🧹 Fichier temporaire supprimé")
-            except:
-                pass
+                with metrics.timer("buffer_stage_seconds", stage="text"):
+                    if count > 1:
+                        texts = await generate_unique_chaos_texts(count, label=label)
+                        self.stats["batches"] += 1
+                    else:
+                        chaos_text = await generate_unique_chaos_text(label=label)
+                        texts = [chaos_text] if chaos_text else []
+            except Exception as e:
+                print(f"❌ {label}Erreur: {type(e).__name__}: {e}")
+                texts = []
+            finally:
+                self.text_active -= 1
 
+            # Les commandes non servies par le lot sont abandonnées (le superviseur recommandera).
+            # Un lot partiel n'est pas une panne du fournisseur : pas de backoff dans ce cas.
+            for _ in range(count - len(texts)):
+                print("❌ Échec génération texte pour le buffer")
+                self.stats["text_errors"] += 1
+                self._finish(ok=bool(texts))
 
-def generate_chaos_text_sync(prompt):
-    """Génère du texte avec Gemini (fonction synchrone pour run_in_executor)"""
-    try:
-        response = gemini_client.models.generate_content(
-            model="gemini-3-pro-preview",
-            contents=prompt,
-        )
-        return response.text
-    except Exception as e:
-        print(f"❌ Erreur Gemini: {type(e).__name__}: {e}")
-        return None
+            for chaos_text in texts:
+                self.stats["text_ok"] += 1
+                # Bloque si l'étage TTS est saturé (file bornée)
+                await self.texts.put((chaos_text, started))
+
+    async def _tts_worker(self, worker_id):
+        """Étage 2 : synthétise le TTS et ajoute l'entrée au buffer"""
+        while True:
+            chaos_text, started = await self.texts.get()
+            self.tts_active += 1
+            requeued = False
+            added = False
+            try:
+                print(f"🎤 [TTS #{worker_id}] Génération du TTS pour le buffer...")
+                if shared_coordinator is not None:
+                    await shared_coordinator.sync_settings()
+                fingerprint = tts_fingerprint()
+                with metrics.timer("buffer_stage_seconds", stage="tts"):
+                    data = await generate_tts_audio(chaos_text)
 
+                if not data:
+                    print("❌ Échec génération TTS pour le buffer")
+                    self.stats["tts_errors"] += 1
+                    continue
 
-async def generate_chaos_text(prompt):
-    """Génère du texte avec Gemini (async wrapper)"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, generate_chaos_text_sync, prompt)
+                # Paramètres modifiés pendant la synthèse : on garde le texte, on refait le TTS
+                if fingerprint != tts_fingerprint():
+                    print("🔁 Paramètres TTS modifiés pendant la synthèse, nouvelle synthèse...")
+                    self.resynthesize(chaos_text)
+                    requeued = True
+                    continue
 
+                # Encodage Opus une fois pour toutes : la lecture n'aura plus rien à encoder
+                if shared_coordinator is not None:
+                    await shared_coordinator.push(chaos_text, data, fingerprint)
+                else:
+                    audio = await store_buffer_audio(data)
+                    async with buffer_lock:
+                        prompt_buffer.append({
+                            "text": chaos_text,
+                            "audio": audio,
+                            "fingerprint": fingerprint,
+                        })
+                print(f"✅ Prompt ajouté au buffer (maintenant: {buffered_count()}/{buffer_target()})")
+                startup.mark("premier prompt")
+                self.stats["tts_ok"] += 1
+                added = True
+                if started is not None:
+                    metrics.observe("buffer_entry_seconds", time.monotonic() - started)
+                    demand.record_generation(time.monotonic() - started, len(chaos_text))
+                else:
+                    demand.record_characters(len(chaos_text))
+                await save_spool_manifest()
+            except Exception as e:
+                print(f"❌ [TTS #{worker_id}] Erreur: {type(e).__name__}: {e}")
+                self.stats["tts_errors"] += 1
+            finally:
+                self.tts_active -= 1
+                if not requeued:
+                    metrics.inc("buffer_entries_total", result="added" if added else "failed")
+                    self._finish(ok=added)
+
+    def resynthesize(self, chaos_text, new_entry=False):
+        """Renvoie un texte déjà généré à l'étage TTS, sans nouvel appel Gemini"""
+        if new_entry:
+            self.in_flight += 1
+            self.idle.clear()
+        self.stats["resynthesized"] += 1
+        # Tâche séparée : un worker TTS ne doit jamais attendre sa propre file
+        spawn(self.texts.put((chaos_text, None)))
+
+
+buffer_pipeline = BufferPipeline(TEXT_CONCURRENCY, TTS_CONCURRENCY, PIPELINE_QUEUE_SIZE, GEMINI_BATCH_SIZE)
+
+
+def buffered_count():
+    """Prompts prêts : buffer de ce processus, ou store partagé par tous les processus"""
+    if shared_coordinator is not None:
+        return shared_coordinator.count
+    return len(prompt_buffer)
 
-# ===== SYSTÈME DE BUFFER =====
 
 async def generate_and_buffer_prompt():
-    """Génère un prompt complet (texte + TTS) et l'ajoute au buffer"""
-    global is_generating, last_prompt
+    """Commande au pipeline les entrées qui manquent pour remplir le buffer (non bloquant)"""
+    # Mode partagé : seuls les producteurs (workers, ou processus détenant le bail) remplissent
+    if shared_coordinator is not None and not shared_coordinator.produces():
+        return False
     
-    # Vérifier si on peut générer (sans bloquer)
     async with buffer_lock:
-        if is_generating:
-            print("⏳ Génération déjà en cours, skip...")
-            return False
-        if len(prompt_buffer) >= 3:
-            print("📦 Buffer déjà plein, skip...")
-            return False
-        is_generating = True
+        target = buffer_target()
+        if shared_coordinator is not None:
+            # Les entrées en cours chez les autres producteurs comptent aussi
+            missing = await shared_coordinator.reserve(target, buffer_pipeline.in_flight)
+        else:
+            missing = target - len(prompt_buffer) - buffer_pipeline.in_flight
+    
+    if missing <= 0:
+        return False
     
+    print(f"🔄 Commande de {missing} prompt(s) pour le buffer (actuel: {buffered_count()}/{target})...")
+    buffer_pipeline.request(missing)
+    return True
+
+
+async def encode_tts_opus(data):
+    """Pré-encode un audio TTS du buffer en Opus. Sans libopus/FFmpeg, la lecture
+    se fera via FFmpeg comme avant. Retourne les paquets, ou None."""
+    global opus_available
+    if not OPUS_PREENCODE or not opus_available:
+        return None
+    loop = asyncio.get_running_loop()
     try:
-        print(f"🔄 Génération d'un nouveau prompt pour le buffer (actuel: {len(prompt_buffer)}/3)...")
-        
-        # 1. Construire et générer le texte
-        prompt = build_chaos_prompt()
-        last_prompt = prompt
-        
-        print("🤖 Génération du texte avec Gemini...")
-        chaos_text = await generate_chaos_text(prompt)
-        
-        if not chaos_text:
-            print("❌ Échec génération texte pour le buffer")
-            return False
-        
-        # 2. Générer le TTS
-        print("🎤 Génération du TTS pour le buffer...")
-        tts_file = await generate_tts_file(chaos_text)
-        
-        if not tts_file:
-            print("❌ Échec génération TTS pour le buffer")
-            return False
-        
-        # 3. Ajouter au buffer
-        async with buffer_lock:
-            prompt_buffer.append({
-                "text": chaos_text,
-                "tts_file": tts_file
-            })
-            print(f"✅ Prompt ajouté au buffer (maintenant: {len(prompt_buffer)}/3)")
-        
-        return True
-            
+        with metrics.timer("opus_encode_seconds"):
+            return await loop.run_in_executor(None, transcode_tts_opus_sync, data)
+    except discord.opus.OpusNotLoaded:
+        opus_available = False
+        print("⚠️ libopus introuvable : pas de pré-encodage Opus, lecture via FFmpeg")
     except Exception as e:
-        print(f"❌ Erreur lors de la génération pour le buffer: {e}")
-        return False
-    finally:
-        async with buffer_lock:
-            is_generating = False
+        print(f"⚠️ Pré-encodage Opus impossible ({type(e).__name__}: {e}), lecture via FFmpeg")
+    return None
 
 
-async def refill_buffer():
-    """Remplit le buffer jusqu'à 3 prompts (lance une seule génération à la fois)"""
-    if len(prompt_buffer) < 3:
-        await generate_and_buffer_prompt()
-    # Si encore besoin après, la background task s'en chargera
+async def store_buffer_audio(data):
+    """Prépare l'audio d'une entrée du buffer : paquets Opus, copie durable dans le spool
+    (pour le redémarrage) et version en mémoire pour la lecture"""
+    packets = await encode_tts_opus(data)
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(None, write_audio_files_sync, SPOOL_DIR, data, packets)
+    return await audio_store.put(data, packets, path)
+
+
+async def refresh_stale_entries():
+    """Re-synthétise les entrées du buffer générées avec d'anciens paramètres TTS.
+    Le texte Gemini est conservé : seul le TTS est refait."""
+    fingerprint = tts_fingerprint()
+    if shared_coordinator is not None:
+        # Buffer commun : périmé par rapport aux paramètres du store (déjà ignoré par pop).
+        # Tout producteur peut le rafraîchir : le retrait est atomique, chaque texte part une fois.
+        if not shared_coordinator.produces():
+            return
+        texts = await shared_coordinator.take_stale()
+        if texts:
+            print(f"🔁 {len(texts)} prompt(s) du buffer partagé à re-synthétiser avec les nouveaux paramètres")
+        for text in texts:
+            buffer_pipeline.resynthesize(text, new_entry=True)
+        return
+    
+    async with buffer_lock:
+        stale = [entry for entry in prompt_buffer if entry.get("fingerprint") != fingerprint]
+        for entry in stale:
+            prompt_buffer.remove(entry)
+    
+    if not stale:
+        return
+    
+    print(f"🔁 {len(stale)} prompt(s) du buffer à re-synthétiser avec les nouveaux paramètres")
+    for entry in stale:
+        await entry["audio"].release()
+        buffer_pipeline.resynthesize(entry["text"], new_entry=True)
+    await save_spool_manifest()
+
+
+def on_tts_settings_changed():
+    """À appeler après chaque modification des paramètres TTS"""
+    spawn(publish_tts_settings())
+    signal_refill()
+
+
+async def publish_tts_settings():
+    """Partage les nouveaux paramètres (les autres processus les reprennent),
+    puis fait re-synthétiser les entrées périmées"""
+    if shared_coordinator is not None:
+        await shared_coordinator.publish_settings()
+    await refresh_stale_entries()
 
 
 async def get_buffered_prompt():
     """Récupère un prompt du buffer (ou None si vide)"""
+    if shared_coordinator is not None:
+        entry = await shared_coordinator.pop()
+        if entry is None:
+            return None
+        signal_refill()
+        return entry
+    
     async with buffer_lock:
-        if prompt_buffer:
-            return prompt_buffer.popleft()
-        return None
+        if not prompt_buffer:
+            return None
+        entry = prompt_buffer.popleft()
+    signal_refill()
+    await save_spool_manifest()
+    return entry
+
+
+# ===== SPOOL PERSISTANT DU BUFFER =====
+# Les fichiers TTS du buffer vivent dans SPOOL_DIR, décrits par un manifeste
+# réécrit de façon atomique : le buffer est rechargé tel quel au redémarrage.
+
+def write_spool_manifest_sync(entries):
+    """Écrit le manifeste du spool de façon atomique (fichier temporaire + os.replace)"""
+    manifest = {
+        "version": 1,
+        "entries": [
+            {
+                "text": entry["text"],
+                "tts_file": os.path.basename(entry["audio"].path),
+                "size": entry["audio"].size,
+                "fingerprint": entry.get("fingerprint"),
+            }
+            for entry in entries
+            if entry["audio"].path and os.path.exists(entry["audio"].path)
+        ],
+    }
+    tmp_path = SPOOL_MANIFEST + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, SPOOL_MANIFEST)
+
+
+async def save_spool_manifest():
+    """Sauvegarde l'état actuel du buffer dans le manifeste du spool"""
+    if shared_coordinator is not None:
+        return  # Le store partagé fait office de manifeste
+    async with spool_lock:
+        async with buffer_lock:
+            entries = list(prompt_buffer)
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, write_spool_manifest_sync, entries)
+        except Exception as e:
+            print(f"⚠️ Impossible d'écrire le manifeste du spool: {e}")
+
+
+def load_spool_sync():
+    """Relit le manifeste, valide les fichiers et supprime les fichiers orphelins.
+    Retourne la liste des entrées valides."""
+    entries = []
+    try:
+        with open(SPOOL_MANIFEST, encoding="utf-8") as f:
+            manifest = json.load(f)
+        for item in manifest.get("entries", []):
+            tts_file = os.path.join(SPOOL_DIR, os.path.basename(item["tts_file"]))
+            if not os.path.isfile(tts_file):
+                continue
+            size = os.path.getsize(tts_file)
+            if size == 0 or size != item.get("size", size):
+                continue
+            entries.append({
+                "text": item["text"],
+                "tts_file": tts_file,
+                "size": size,
+                "fingerprint": item.get("fingerprint"),
+            })
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Manifeste du spool illisible, buffer repart de zéro: {e}")
+        entries = []
+
+    entries = entries[:BUFFER_MAX_SIZE]
+
+    # Garbage collection : tout fichier non référencé est supprimé
+    kept = {os.path.basename(path) for entry in entries
+            for path in (entry["tts_file"], opus_sidecar(entry["tts_file"]))}
+    removed = 0
+    for name in os.listdir(SPOOL_DIR):
+        if name in kept or name == os.path.basename(SPOOL_MANIFEST):
+            continue
+        try:
+            os.remove(os.path.join(SPOOL_DIR, name))
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        print(f"🧹 Spool: {removed} fichier(s) orphelin(s) supprimé(s)")
+
+    return entries
+
+
+def gc_shared_spool_sync(store):
+    """Mode partagé : supprime les fichiers du spool qui n'ont plus ni ligne dans le buffer
+    ni bail de lecture. Un fichier récent sans ligne peut être en cours d'écriture par un
+    autre processus (la ligne est ajoutée après) : il est épargné."""
+    kept = set()
+    for name in store.referenced_files():
+        kept.update((name, os.path.basename(opus_sidecar(name))))
+    cutoff = time.time() - SPOOL_ORPHAN_AGE
+    removed = 0
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if name not in kept and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+async def load_spool():
+    """Recharge le buffer depuis le spool (une seule fois, au démarrage)"""
+    global spool_loaded
+    if spool_loaded:
+        return
+    spool_loaded = True
+
+    loop = asyncio.get_running_loop()
+    if shared_coordinator is not None:
+        # Les prompts sont déjà dans le store partagé : rien à recharger
+        removed = await loop.run_in_executor(None, gc_shared_spool_sync, shared_coordinator.store)
+        if removed:
+            print(f"🧹 Spool: {removed} fichier(s) orphelin(s) supprimé(s)")
+        print(f"💾 Store partagé: {shared_coordinator.count} prompt(s) prêt(s)")
+        return
+    entries = await loop.run_in_executor(None, load_spool_sync)
+    for entry in entries:
+        entry["audio"] = audio_store.adopt(entry.pop("tts_file"), entry.pop("size"))
+    async with buffer_lock:
+        prompt_buffer.extend(entries)
+    await save_spool_manifest()
+    print(f"💾 Spool: {len(entries)} prompt(s) rechargé(s) depuis le disque")
+
+    # Remettre les audios en mémoire (dans la limite du budget), en arrière-plan.
+    # Entrées d'avant le pré-encodage : les paquets Opus sont produits au passage.
+    async def warm_entries():
+        for entry in entries:
+            audio = entry["audio"]
+            if audio.refs <= 0:
+                continue
+            if OPUS_PREENCODE and opus_available and not os.path.exists(opus_sidecar(audio.path)):
+                data, _ = await audio.read()
+                packets = await encode_tts_opus(data)
+                if packets and audio.refs > 0:
+                    await loop.run_in_executor(None, write_opus_packets_sync, opus_sidecar(audio.path), packets)
+            await audio_store.warm(audio)
+    spawn(warm_entries())
+
+
+def signal_refill():
+    """Réveille le superviseur de remplissage (entrée consommée, paramètres modifiés...)"""
+    refill_event.set()
+
+
+async def wait_for_refill():
+    """Attend un signal de remplissage. En mode partagé, les prompts consommés par
+    les autres processus sont détectés via PRAGMA data_version."""
+    if shared_coordinator is None:
+        await refill_event.wait()
+        return
+    while not refill_event.is_set():
+        try:
+            await asyncio.wait_for(refill_event.wait(), SHARED_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            try:
+                if await shared_coordinator.refresh():
+                    return
+            except sqlite3.Error as e:
+                print(f"⚠️ Store partagé illisible: {e}")
+
 
+def refill_backoff_delay(failures):
+    """Délai avant de relancer des générations après des erreurs consécutives (avec jitter)"""
+    if failures <= 0:
+        return 0
+    delay = min(REFILL_BACKOFF_MAX, REFILL_BACKOFF_BASE * 2 ** (failures - 1))
+    return delay * random.uniform(0.5, 1.5)
 
-async def background_buffer_task():
-    """Tâche de fond qui maintient le buffer rempli"""
-    await bot.wait_until_ready()
-    print("🔄 Démarrage de la tâche de remplissage du buffer...")
+
+async def refill_supervisor():
+    """Superviseur unique du remplissage : dort jusqu'à ce qu'on le réveille, jamais de polling.
+    Démarre sans attendre la gateway : le remplissage initial avance pendant la connexion."""
+    print("🔄 Démarrage du superviseur de remplissage du buffer...")
     
-    # Remplissage initial (3 prompts)
-    await generate_and_buffer_prompt()
-    await generate_and_buffer_prompt()
+    if CHAOS_ROLE != "gateway":
+        buffer_pipeline.start()
+    
+    # Remplissage initial (les entrées sont générées en parallèle par le pipeline)
     await generate_and_buffer_prompt()
-    print(f"✅ Buffer initial rempli: {len(prompt_buffer)}/3 prompts prêts")
+    await buffer_pipeline.idle.wait()
+    print(f"✅ Buffer initial rempli: {buffered_count()}/{buffer_target()} prompts prêts")
+    startup.mark("buffer rempli")
     
-    # Boucle de maintenance
     while not bot.is_closed():
+        await wait_for_refill()
+        refill_event.clear()
         try:
-            # Vérifier si on a besoin de regénérer
-            if len(prompt_buffer) < 3 and not is_generating:
-                await generate_and_buffer_prompt()
-            await asyncio.sleep(2)  # Vérifie toutes les 2 secondes
+            # Erreurs fournisseur en série : on espace les nouvelles tentatives
+            delay = refill_backoff_delay(buffer_pipeline.consecutive_failures)
+            if delay:
+                print(f"⏸️ {buffer_pipeline.consecutive_failures} échec(s) de génération, nouvelle tentative dans {delay:.1f}s")
+                await asyncio.sleep(delay)
+                refill_event.clear()
+            await generate_and_buffer_prompt()
         except Exception as e:
-            print(f"❌ Erreur dans la tâche de buffer: {e}")
-            await asyncio.sleep(5)
+            print(f"❌ Erreur dans le superviseur de buffer: {e}")
+
+
+# ===== SESSIONS PAR SERVEUR =====
+
+class ChaosRequest:
+    """Demande de !chaos en attente. Les doublons rapprochés pour le même canal la
+    rejoignent : une seule lecture, un seul prompt du buffer pour tous les demandeurs."""
+
+    def __init__(self, ctx, job, channel, future):
+        self.contexts = [ctx]
+        self.job = job
+        self.channel = channel
+        self.future = future
+        self.queued_at = time.monotonic()
+
+    def join(self, ctx):
+        if all(other.author != ctx.author for other in self.contexts):
+            self.contexts.append(ctx)
+
+    def context(self):
+        """Contexte d'un demandeur encore dans le canal (le premier arrivé de préférence)"""
+        for ctx in self.contexts:
+            voice = ctx.author.voice
+            if voice is not None and voice.channel == self.channel:
+                return ctx
+        return self.contexts[0]
+
+    def describe(self):
+        names = ", ".join(ctx.author.display_name for ctx in self.contexts)
+        return f"🔈 {self.channel.name} · {names}"
+
+
+class GuildSession:
+    """Session de lecture d'un serveur : une seule connexion vocale par serveur,
+    donc une file de demandes jouées dans l'ordre"""
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = deque()  # ChaosRequest en attente
+        self.worker = None  # Tâche qui vide la file
+        self.current = None  # Demande en cours de lecture
+
+    def is_busy(self):
+        return self.current is not None or bool(self.queue)
+
+    def pending(self, channel):
+        """Demandes en attente pour un canal vocal"""
+        return [request for request in self.queue if request.channel == channel]
+
+    def position(self, request):
+        """Position dans la file (1 = prochaine lecture, ou en cours)"""
+        if request is self.current:
+            return 1
+        return self.queue.index(request) + (2 if self.current else 1)
+
+
+class ChaosScheduler:
+    """Ordonnanceur central : les serveurs tournent en parallèle,
+    les commandes d'un même serveur sont jouées l'une après l'autre"""
+
+    def __init__(self, max_concurrent, max_depth, coalesce_window):
+        self.sessions = {}
+        self.max_concurrent = max_concurrent
+        self.max_depth = max_depth
+        self.coalesce_window = coalesce_window
+        self.slots = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else nullcontext()
+
+    def get_session(self, guild_id):
+        """Retourne la session du serveur (créée si besoin)"""
+        session = self.sessions.get(guild_id)
+        if session is None:
+            session = GuildSession(guild_id)
+            self.sessions[guild_id] = session
+        return session
+
+    def enqueue(self, ctx, job):
+        """Place une demande dans la file du serveur, sans rien consommer : le prompt du
+        buffer n'est pris qu'au moment de jouer. Retourne (demande, position, regroupée),
+        ou None si la file du canal est pleine."""
+        session = self.get_session(ctx.guild.id)
+        channel = ctx.author.voice.channel
+        pending = session.pending(channel)
+
+        # Doublon rapproché : on rejoint la dernière demande pour ce canal (en attente, ou
+        # en cours de lecture : le demandeur l'entend déjà)
+        latest = pending[-1] if pending else session.current
+        if latest is not None and latest.channel == channel and time.monotonic() - latest.queued_at <= self.coalesce_window:
+            request = latest
+            request.join(ctx)
+            metrics.inc("chaos_requests_total", result="coalesced")
+            return request, session.position(request), True
+
+        if len(pending) >= self.max_depth:
+            metrics.inc("chaos_requests_total", result="rejected")
+            return None
+
+        request = ChaosRequest(ctx, job, channel, asyncio.get_running_loop().create_future())
+        session.queue.append(request)
+        metrics.inc("chaos_requests_total", result="queued")
+
+        position = session.position(request)
+        if position > 1:
+            print(f"📥 [{ctx.guild.name}] Commande en file (position {position})")
+
+        # Un seul worker par serveur : il sérialise les lectures
+        if session.worker is None or session.worker.done():
+            session.worker = asyncio.create_task(self._run_session(session))
+
+        return request, position, False
+
+    async def _run_session(self, session):
+        """Vide la file d'un serveur (en respectant la limite globale de sessions, si elle est définie)"""
+        while session.queue:
+            request = session.queue.popleft()
+            session.current = request
+            try:
+                async with self.slots:
+                    result = await request.job(request.context())
+                if not request.future.done():
+                    request.future.set_result(result)
+            except Exception as e:
+                print(f"❌ [{session.guild_id}] Erreur dans la session: {type(e).__name__}: {e}")
+                if not request.future.done():
+                    request.future.set_exception(e)
+            finally:
+                session.current = None
+
+        # Plus rien à jouer : on libère la session
+        if self.sessions.get(session.guild_id) is session:
+            del self.sessions[session.guild_id]
+
+    def active_count(self):
+        """Nombre de serveurs en train de jouer"""
+        return sum(1 for s in self.sessions.values() if s.current is not None)
+
+    def queued_count(self):
+        """Demandes en attente, tous serveurs confondus"""
+        return sum(len(s.queue) for s in self.sessions.values())
+
+
+scheduler = ChaosScheduler(MAX_CONCURRENT_SESSIONS, CHAOS_QUEUE_MAX_DEPTH, CHAOS_COALESCE_WINDOW)
+
+
+# Jauges lues au moment de l'export (état courant plutôt qu'événements)
+metrics.gauge("chaos_buffer_entries", lambda: buffered_count(), "Prompts prêts dans le buffer")
+metrics.gauge("chaos_buffer_target", lambda: buffer_target(), "Profondeur visée du buffer")
+metrics.gauge("chaos_buffer_in_flight", lambda: buffer_pipeline.in_flight, "Entrées en cours de génération")
+metrics.gauge("chaos_demand_per_minute", lambda: round(demand.current_rate() * 60, 3), "Demande estimée (!chaos par minute)")
+metrics.gauge("tts_cache_hits", lambda: tts_cache.hits, "Hits du cache TTS")
+metrics.gauge("tts_cache_misses", lambda: tts_cache.misses, "Misses du cache TTS")
+metrics.gauge("tts_cache_bytes", lambda: tts_cache.total_bytes, "Taille du cache TTS")
+metrics.gauge("audio_store_memory_bytes", lambda: audio_store.memory_bytes, "Audios prêts gardés en mémoire")
+metrics.gauge("audio_store_live", lambda: audio_store.live, "Audios non encore libérés")
+metrics.gauge("chaos_sessions_active", lambda: scheduler.active_count(), "Serveurs en train de jouer")
+metrics.gauge("voice_pool_connected", lambda: len(bot.voice_clients), "Connexions vocales ouvertes")
+
+
+async def warm_start():
+    """Préparation du bot, lancée depuis setup_hook en parallèle de la connexion à la gateway"""
+    loop = asyncio.get_running_loop()
+    
+    # Indépendants du buffer : tournent pendant tout le reste
+    side_tasks = [
+        asyncio.create_task(load_static_clips()),  # Clips statiques décodés une fois pour toutes
+        asyncio.create_task(elevenlabs_keys.refresh_all()),  # Quota restant de chaque clé
+        asyncio.create_task(providers.warmup()),  # Connexion Gemini ouverte avant la 1re génération
+    ]
+    
+    async def load_history():
+        # Historique des textes (détection des doublons)
+        if not chaos_history.signatures:
+            await loop.run_in_executor(None, chaos_history.load)
+            print(f"📚 Historique: {len(chaos_history.signatures)} texte(s) indexé(s)")
+    
+    async def load_buffer():
+        # Buffer sauvegardé avant le redémarrage (ou commun aux processus)
+        if shared_coordinator is not None:
+            await shared_coordinator.start()
+        await load_spool()
+        await refresh_stale_entries()
+        if buffered_count():
+            startup.mark("premier prompt")
+    
+    await asyncio.gather(load_history(), load_buffer())
+    
+    # Démarrer le superviseur du buffer (une seule fois)
+    global refill_task
+    if refill_task is None or refill_task.done():
+        refill_task = asyncio.create_task(refill_supervisor())
+    
+    await asyncio.gather(*side_tasks, return_exceptions=True)
+    startup.mark("préparation terminée")
 
 
 @bot.event
 async def on_ready():
     print(f'✅ Bot connecté en tant que {bot.user}')
     print(f'📦 Serveurs: {len(bot.guilds)}')
-    print(f'🤖 Modèle Gemini: gemini-3-pro-preview')
+    print(f'🧩 Shards: {", ".join(map(str, bot.shards)) or "aucun"} (sur {bot.shard_count})')
+    print(f'🤖 Modèle Gemini: {GEMINI_MODEL}')
     print(f'🔑 Clés ElevenLabs: {len(ELEVENLABS_API_KEYS)} clés chargées')
-    print(f'📦 Système de buffer activé (3 prompts en avance)')
+    print(f'📦 Système de buffer adaptatif activé ({BUFFER_MIN_SIZE} à {BUFFER_MAX_SIZE} prompts en avance)')
+    startup.mark("gateway")
     
-    # Démarrer la tâche de fond pour maintenir le buffer
-    bot.loop.create_task(background_buffer_task())
+    # Endpoint Prometheus local (optionnel)
+    global metrics_runner
+    if metrics_runner is None:
+        try:
+            metrics_runner = await start_metrics_server()
+        except OSError as e:
+            print(f"⚠️ Endpoint de métriques indisponible: {e}")
 
 
 @bot.command(name='chaos')
@@ -468,154 +3376,407 @@ async def chaos(ctx):
         await ctx.send("❌ Tu dois être dans un canal vocal !")
         return
     
-    # 1. Essayer de récupérer un prompt du buffer
-    buffered = await get_buffered_prompt()
+    received_at = time.perf_counter()
     
-    if buffered:
-        # On a un prompt prêt !
-        chaos_text = buffered["text"]
-        tts_file = buffered["tts_file"]
-        print(f"⚡ Utilisation d'un prompt buffered (reste: {len(prompt_buffer)}/3)")
-        
-        # 2. Se connecter au canal vocal IMMÉDIATEMENT
-        voice_client = await ensure_voice_connection(ctx)
-        if not voice_client:
-            # Nettoyer le fichier TTS si connexion échouée
-            if os.path.exists(tts_file):
-                os.remove(tts_file)
-            return
-        
-        # 3. Lancer le remplissage du buffer en arrière-plan (pendant qu'on joue)
-        bot.loop.create_task(generate_and_buffer_prompt())
-        
-        # 4. Jouer le son d'intro (kaamelott)
-        await play_audio_file(voice_client, "kaamelott.mp3")
-        
-        # 5. Envoyer le texte sur Discord
-        await ctx.send(f"📜 **Le Chaos a parlé:**\n\n{chaos_text}")
-        
-        # 6. Jouer le TTS
-        await play_tts_file(voice_client, tts_file, delete_after=True)
-        
-        # 7. Ajouter à l'historique
-        generated_history.append(chaos_text)
-        
-        # 8. Déconnecter le bot
-        await voice_client.disconnect()
-        print("👋 Bot déconnecté du canal vocal")
-        
+    # La session du serveur joue les commandes une par une
+    queued = scheduler.enqueue(ctx, lambda ctx: run_chaos(ctx, received_at))
+    if queued is None:
+        await ctx.send(f"⛔ Déjà {CHAOS_QUEUE_MAX_DEPTH} `!chaos` en attente pour ce canal, réessaie plus tard !")
+        return
+    
+    request, position, coalesced = queued
+    if coalesced:
+        # Même lecture pour tout le monde : ni prompt ni demande en plus
+        await ctx.send(f"👥 Un `!chaos` est déjà prévu pour ce canal (position {position}), tu l'entendras avec les autres !")
     else:
-        # Buffer vide, on doit générer à la volée (fallback)
-        await ctx.send("🎲 *Invocation du chaos en cours... (buffer vide, génération en cours)*")
-        
-        prompt = build_chaos_prompt()
-        global last_prompt
-        last_prompt = prompt
-        
-        print("🤖 Génération du texte avec Gemini (fallback)...")
-        chaos_text = await generate_chaos_text(prompt)
-        
-        if not chaos_text:
-            await ctx.send("❌ Erreur lors de la génération du texte")
-            return
-        
-        print("🎤 Génération du TTS (fallback)...")
-        tts_file = await generate_tts_file(chaos_text)
-        
-        if not tts_file:
-            await ctx.send("❌ Erreur lors de la génération du TTS")
-            return
-        
-        # Se connecter au canal vocal
-        voice_client = await ensure_voice_connection(ctx)
-        if not voice_client:
-            if os.path.exists(tts_file):
-                os.remove(tts_file)
-            return
-        
-        # Jouer le son d'intro
-        await play_audio_file(voice_client, "kaamelott.mp3")
-        
-        # Envoyer le texte
-        await ctx.send(f"📜 **Le Chaos a parlé:**\n\n{chaos_text}")
-        
-        # Jouer le TTS
-        await play_tts_file(voice_client, tts_file, delete_after=True)
-        
-        # Ajouter à l'historique
-        generated_history.append(chaos_text)
+        # Alimente l'estimation de la demande (profondeur du buffer), commune aux processus
+        if shared_coordinator is not None:
+            shared_coordinator.record_command()
+        else:
+            demand.record_command()
+        if position > 1:
+            await ctx.send(f"📥 `!chaos` en file (position {position}), `!queue` pour suivre")
+    
+    await request.future
+
+
+class ChaosTimeline:
+    """Jalons d'un !chaos, mesurés depuis la réception de la commande"""
+    
+    def __init__(self, received_at=None):
+        self.received_at = received_at if received_at is not None else time.perf_counter()
+        self.path = "buffer"
+    
+    def elapsed(self):
+        return time.perf_counter() - self.received_at
+    
+    def stage(self, stage):
+        """Chronomètre une étape de la séquence"""
+        return metrics.timer("chaos_stage_seconds", stage=stage, path=self.path)
+    
+    def first_audio(self):
+        """Le son d'intro démarre : premier retour audible pour l'utilisateur"""
+        metrics.observe("chaos_time_to_first_audio_seconds", self.elapsed(), path=self.path)
+    
+    def speech(self):
+        """La lecture du TTS démarre"""
+        metrics.observe("chaos_time_to_speech_seconds", self.elapsed(), path=self.path)
+
+
+async def run_chaos(ctx, received_at=None):
+    """Séquence complète d'un !chaos (exécutée par la session du serveur)"""
+    timeline = ChaosTimeline(received_at)
+    metrics.observe("chaos_queue_wait_seconds", timeline.elapsed())
+    
+    # L'utilisateur a pu quitter le vocal pendant l'attente dans la file
+    if ctx.author.voice is None or ctx.author.voice.channel is None:
+        await ctx.send("❌ Tu dois être dans un canal vocal !")
+        return
+    
+    # Connexion d'abord quand le buffer a du stock : un prompt pré-généré n'est
+    # consommé que pour une lecture qui a vraiment lieu
+    voice_client = None
+    try:
+        if buffered_count():
+            with timeline.stage("voice_connect"):
+                voice_client = await ensure_voice_connection(ctx)
+            if not voice_client:
+                return
         
-        # Déconnecter
-        await voice_client.disconnect()
-        print("👋 Bot déconnecté du canal vocal")
+        # 1. Essayer de récupérer un prompt du buffer
+        buffered = await get_buffered_prompt()
+        timeline.path = "buffer" if buffered else "fallback"
+        metrics.inc("chaos_commands_total", path=timeline.path)
         
-        # Relancer le remplissage du buffer après
-        bot.loop.create_task(refill_buffer())
+        if buffered:
+            # On a un prompt prêt !
+            chaos_text = buffered["text"]
+            audio = buffered["audio"]
+            print(f"⚡ Utilisation d'un prompt buffered (reste: {buffered_count()}/{buffer_target()})")
+            
+            try:
+                # 2. Se connecter au canal vocal (si ce n'est pas déjà fait)
+                if voice_client is None:
+                    with timeline.stage("voice_connect"):
+                        voice_client = await ensure_voice_connection(ctx)
+                if not voice_client:
+                    return
+                
+                # 4. Jouer le son d'intro (kaamelott)
+                with timeline.stage("intro"):
+                    await play_audio_file(voice_client, "kaamelott.mp3", on_start=timeline.first_audio)
+                
+                # 5. Envoyer le texte sur Discord
+                await ctx.send(f"📜 **Le Chaos a parlé:**\n\n{chaos_text}")
+                
+                # 6. Jouer le TTS
+                with timeline.stage("tts_playback"):
+                    await play_tts_audio(voice_client, audio, on_start=timeline.speech)
+            finally:
+                # L'audio est libéré dans tous les cas (connexion échouée, annulation...)
+                await audio.release()
+            
+        else:
+            # Buffer vide, on doit générer à la volée (fallback)
+            await ctx.send("🎲 *Invocation du chaos en cours... (buffer vide, génération en cours)*")
+            
+            # Une seule tentative : l'utilisateur attend déjà (le texte est tout de même indexé)
+            with timeline.stage("text"):
+                chaos_text = await generate_unique_chaos_text(max_attempts=1, label="(fallback) ", accept_duplicate=True)
+            
+            if not chaos_text:
+                await ctx.send("❌ Erreur lors de la génération du texte")
+                return
+            
+            # Mode partagé : paramètres de voix éventuellement modifiés sur un autre processus
+            if shared_coordinator is not None:
+                await shared_coordinator.sync_settings()
+            
+            if TTS_STREAMING:
+                # La synthèse démarre tout de suite et continue pendant la connexion et l'intro
+                print("🎤 Streaming du TTS (fallback)...")
+                tts_stream = start_tts_stream(chaos_text)
+                
+                with timeline.stage("voice_connect"):
+                    voice_client = await ensure_voice_connection(ctx)
+                if not voice_client:
+                    tts_stream.cancel()
+                    return
+                
+                with timeline.stage("intro"):
+                    await play_audio_file(voice_client, "kaamelott.mp3", on_start=timeline.first_audio)
+                await ctx.send(f"📜 **Le Chaos a parlé:**\n\n{chaos_text}")
+                
+                with timeline.stage("tts_playback"):
+                    played = await play_tts_stream(voice_client, tts_stream, on_start=timeline.speech)
+                if not played:
+                    await ctx.send("❌ Erreur lors de la génération du TTS")
+            else:
+                print("🎤 Génération du TTS (fallback)...")
+                with timeline.stage("tts"):
+                    data = await generate_tts_audio(chaos_text)
+                
+                if not data:
+                    await ctx.send("❌ Erreur lors de la génération du TTS")
+                    return
+                
+                audio = await audio_store.put(data)
+                try:
+                    # Se connecter au canal vocal
+                    with timeline.stage("voice_connect"):
+                        voice_client = await ensure_voice_connection(ctx)
+                    if not voice_client:
+                        return
+                    
+                    # Jouer le son d'intro
+                    with timeline.stage("intro"):
+                        await play_audio_file(voice_client, "kaamelott.mp3", on_start=timeline.first_audio)
+                    
+                    # Envoyer le texte
+                    await ctx.send(f"📜 **Le Chaos a parlé:**\n\n{chaos_text}")
+                    
+                    # Jouer le TTS
+                    with timeline.stage("tts_playback"):
+                        await play_tts_audio(voice_client, audio, on_start=timeline.speech)
+                finally:
+                    await audio.release()
+    finally:
+        # Rendre la connexion au pool dans tous les cas (déconnexion après inactivité) :
+        # acquire() a annulé la déconnexion programmée
+        if voice_client:
+            voice_pool.release(voice_client)
 
 
 @bot.command(name='buffer')
 async def buffer_status(ctx):
     """Affiche le statut du buffer de prompts"""
-    global is_generating
+    if buffer_pipeline.in_flight:
+        status = f"🔄 {buffer_pipeline.in_flight} en cours (texte: {buffer_pipeline.text_active}, TTS: {buffer_pipeline.tts_active})"
+    else:
+        status = "✅ Prêt"
     
-    status = "🔄 En cours..." if is_generating else "✅ Prêt"
+    latency = f"{demand.generation_latency:.1f}s" if demand.generation_latency else "pas encore mesurée"
+    quota_limit = demand.quota_limit()
+    quota_text = f"{quota_limit} prompts max" if quota_limit is not None else "pas de limite"
+    if shared_coordinator is not None:
+        role = "générateur" if shared_coordinator.is_generator else "consommateur"
+        sharing = f"store partagé `{SHARED_STORE_PATH}`, ce processus est {role}"
+    else:
+        sharing = "buffer propre à ce processus"
     
     await ctx.send(f"""📦 **Statut du Buffer:**
 
-**Prompts en stock:** {len(prompt_buffer)}/3
+**Démarrage:** {startup.status()}
+**Prompts en stock:** {buffered_count()}/{buffer_target()}
+**Partage:** {sharing}
+**Profondeur visée:** {buffer_target()} (bornes: {BUFFER_MIN_SIZE} à {BUFFER_MAX_SIZE})
+**Demande estimée:** {demand.current_rate() * 3600:.1f} `!chaos`/heure
+**Latence de génération:** {latency}
+**Limite de quota:** {quota_text}
 **Génération:** {status}
+**Pipeline:** {buffer_pipeline.text_concurrency} worker(s) texte, {buffer_pipeline.tts_concurrency} worker(s) TTS, lots de {buffer_pipeline.batch_size} texte(s) max ({buffer_pipeline.stats['batches']} lot(s) générés)
+**Re-synthèses TTS (paramètres modifiés):** {buffer_pipeline.stats['resynthesized']}
+**Historique:** {len(chaos_history.signatures)} texte(s), {chaos_history.rejected} quasi-doublon(s) rejeté(s)
 
 Le buffer pré-génère des prompts pour que `!chaos` soit instantané !""")
 
 
+@bot.command(name='cache')
+async def cache_status(ctx):
+    """Affiche le statut du cache TTS"""
+    lookups = tts_cache.hits + tts_cache.misses
+    hit_rate = tts_cache.hits / lookups * 100 if lookups else 0
+    
+    await ctx.send(f"""💾 **Cache TTS:**
+
+**Audios en cache:** {len(tts_cache.entries)} ({tts_cache.total_bytes / 1024 / 1024:.1f} / {tts_cache.max_bytes / 1024 / 1024:.0f} Mo)
+**Hits:** {tts_cache.hits}
+**Misses:** {tts_cache.misses}
+**Taux de hit:** {hit_rate:.0f}%
+**Évictions:** {tts_cache.evictions}
+
+**Audios prêts en mémoire:** {len(audio_store.resident)} ({audio_store.memory_bytes / 1024 / 1024:.1f} / {audio_store.max_bytes / 1024 / 1024:.0f} Mo)
+**Audios vivants:** {audio_store.live} · **Passés sur disque:** {audio_store.spills} · **Fuites rattrapées:** {audio_store.leaks}
+
+Un même texte avec les mêmes paramètres de voix n'est jamais synthétisé deux fois.""")
+
+
+def format_latency(histogram):
+    """p50 / p95 / p99 d'un histogramme, pour !stats"""
+    if histogram is None or not histogram.samples:
+        return "aucune mesure"
+    p50, p95, p99 = (histogram.percentile(q) for q in (0.5, 0.95, 0.99))
+    return f"p50 {p50:.2f}s · p95 {p95:.2f}s · p99 {p99:.2f}s ({histogram.count})"
+
+
+@bot.command(name='stats')
+async def stats_status(ctx):
+    """Affiche les latences par étape et les compteurs principaux"""
+    hits = metrics.counter("chaos_commands_total", path="buffer")
+    misses = metrics.counter("chaos_commands_total", path="fallback")
+    hit_rate = hits / (hits + misses) * 100 if hits + misses else 0
+    
+    lines = ["📈 **Statistiques:**", ""]
+    lines.append("**Temps avant le premier son:**")
+    for path in ("buffer", "fallback"):
+        lines.append(f"• {path}: {format_latency(metrics.get('chaos_time_to_first_audio_seconds', path=path))}")
+    lines.append("**Temps avant la voix:**")
+    for path in ("buffer", "fallback"):
+        lines.append(f"• {path}: {format_latency(metrics.get('chaos_time_to_speech_seconds', path=path))}")
+    
+    lines.append("")
+    lines.append("**Étapes de !chaos:**")
+    lines.append(f"• attente file: {format_latency(metrics.get('chaos_queue_wait_seconds'))}")
+    stages = sorted({dict(labels)["stage"] for name, labels in metrics.histograms if name == "chaos_stage_seconds"})
+    for stage in stages:
+        for path in ("buffer", "fallback"):
+            histogram = metrics.get("chaos_stage_seconds", stage=stage, path=path)
+            if histogram:
+                lines.append(f"• {stage} ({path}): {format_latency(histogram)}")
+    
+    lines.append("")
+    lines.append("**Fournisseurs et buffer:**")
+    lines.append(f"• connexion vocale: {format_latency(metrics.get('voice_connect_seconds'))}")
+    lines.append(f"• requête Gemini: {format_latency(metrics.get('gemini_request_seconds'))}")
+    lines.append(f"• ElevenLabs (1er chunk): {format_latency(metrics.get('elevenlabs_first_chunk_seconds'))}")
+    lines.append(f"• ElevenLabs (complet): {format_latency(metrics.get('elevenlabs_request_seconds'))}")
+    lines.append(f"• attente d'une clé: {format_latency(metrics.get('elevenlabs_key_wait_seconds'))}")
+    lines.append(f"• entrée de buffer: {format_latency(metrics.get('buffer_entry_seconds'))}")
+    
+    lines.append("")
+    lines.append(f"**Buffer:** {hits} hit(s), {misses} miss(es) ({hit_rate:.0f}% servis depuis le buffer)")
+    limit = f"max {scheduler.max_concurrent}" if scheduler.max_concurrent > 0 else "sans limite"
+    lines.append(f"**Sessions:** {scheduler.active_count()} serveur(s) en lecture ({limit}), "
+                 f"{scheduler.queued_count()} demande(s) en attente")
+    lines.append(f"**Clés:** {metrics.counter('elevenlabs_key_rotations_total')} rotation(s), "
+                 f"{metrics.counter('elevenlabs_key_exhausted_total')} quota(s) épuisé(s), "
+                 f"{metrics.counter('elevenlabs_key_errors_total')} erreur(s)")
+    if METRICS_PORT:
+        lines.append(f"**Prometheus:** http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    
+    await ctx.send("\n".join(lines))
+
+
+@bot.command(name='queue')
+async def queue_status(ctx):
+    """Affiche la file des !chaos du serveur et la position de chaque demande"""
+    session = scheduler.sessions.get(ctx.guild.id)
+    if session is None or not session.is_busy():
+        await ctx.send("📭 Aucun `!chaos` en cours ni en attente")
+        return
+    
+    lines = ["📋 **File des !chaos:**", ""]
+    requests = ([session.current] if session.current else []) + list(session.queue)
+    for request in requests:
+        mine = " ← toi" if any(other.author == ctx.author for other in request.contexts) else ""
+        state = "🔊 en cours" if request is session.current else f"**{session.position(request)}.**"
+        lines.append(f"{state} {request.describe()}{mine}")
+    lines.append("")
+    lines.append(f"Max {scheduler.max_depth} en attente par canal, doublons regroupés pendant {scheduler.coalesce_window:g}s")
+    await ctx.send("\n".join(lines))
+
+
+@bot.command(name='lag')
+async def lag_status(ctx, action: str = None):
+    """Affiche le retard de la boucle et les appels bloquants détectés (`!lag dump` : fichier)"""
+    if loop_watchdog.task is None:
+        await ctx.send("❌ Surveillance de la boucle désactivée (LOOP_WATCHDOG_THRESHOLD_MS=0)")
+        return
+    
+    if action == "dump":
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, loop_watchdog.dump_sync, LOOP_WATCHDOG_DUMP, loop_watchdog.snapshot())
+            await ctx.send(f"💾 {loop_watchdog.stalls} blocage(s) écrit(s) dans `{LOOP_WATCHDOG_DUMP}`")
+        except OSError as e:
+            await ctx.send(f"❌ Impossible d'écrire `{LOOP_WATCHDOG_DUMP}`: {e}")
+        return
+    
+    lag = metrics.get("event_loop_lag_seconds")
+    if lag is None or not lag.samples:
+        lag_text = "aucune mesure"
+    else:
+        p50, p99 = (lag.percentile(q) * 1000 for q in (0.5, 0.99))
+        lag_text = f"p50 {p50:.1f} ms · p99 {p99:.1f} ms · max récent {max(lag.samples) * 1000:.0f} ms"
+    
+    lines = ["🐢 **Boucle asyncio:**", ""]
+    lines.append(f"**Retard:** {lag_text}")
+    lines.append(f"**Blocages > {loop_watchdog.threshold * 1000:.0f} ms:** {loop_watchdog.stalls}")
+    top = loop_watchdog.top_sites()
+    if top:
+        lines.append("")
+        lines.append("**Sites les plus bloquants:**")
+        for site, stats in top:
+            lines.append(f"• `{site}` : {stats['count']}× ({stats['seconds']:.2f}s au total, max {stats['max'] * 1000:.0f} ms)")
+    lines.append("")
+    lines.append("`!lag dump` écrit les piles complètes dans un fichier")
+    await ctx.send("\n".join(lines))
+
+
 @bot.command(name='keys')
 async def keys_status(ctx):
     """Affiche le statut des clés API ElevenLabs"""
-    global current_elevenlabs_key_index
-    
-    total_keys = len(ELEVENLABS_API_KEYS)
-    current_key = current_elevenlabs_key_index + 1
-    remaining_keys = total_keys - current_elevenlabs_key_index
+    now = time.time()
     
     # Construire la liste visuelle des clés
     keys_visual = []
-    for i in range(total_keys):
-        if i < current_elevenlabs_key_index:
-            keys_visual.append(f"~~Clé {i+1}~~ ❌ (épuisée)")
-        elif i == current_elevenlabs_key_index:
-            keys_visual.append(f"**Clé {i+1}** ✅ (active)")
+    for key in elevenlabs_keys.keys:
+        quota = f"{key.remaining} car." if key.remaining is not None else "quota inconnu"
+        if key.cooldown_until > now:
+            until = time.strftime('%d/%m %H:%M', time.localtime(key.cooldown_until))
+            keys_visual.append(f"~~Clé {key.index + 1}~~ ❌ (en pause jusqu'à {until})")
+        elif key.in_flight:
+            keys_visual.append(f"**Clé {key.index + 1}** 🔄 ({key.in_flight} en cours, {quota})")
         else:
-            keys_visual.append(f"Clé {i+1} 💤 (en réserve)")
+            keys_visual.append(f"Clé {key.index + 1} ✅ ({quota})")
     
     keys_list = "\n".join(keys_visual)
+    healthy = sum(1 for key in elevenlabs_keys.keys if key.cooldown_until <= now)
     
     await ctx.send(f"""🔑 **Statut des clés ElevenLabs:**
 
 {keys_list}
 
-**Clé active:** {current_key}/{total_keys}
-**Clés restantes:** {remaining_keys}
+**Clés disponibles:** {healthy}/{len(elevenlabs_keys.keys)}
+**Requêtes simultanées par clé:** {elevenlabs_keys.max_per_key}
 
-Les clés sont automatiquement changées quand le quota est dépassé.""")
+Les requêtes sont réparties sur les clés saines. Une clé épuisée revient toute seule à la remise à zéro de son quota.""")
 
 
 @bot.command(name='reset-keys')
 async def reset_keys(ctx):
-    """Remet les clés API ElevenLabs à la première"""
-    global current_elevenlabs_key_index, elevenlabs_client
+    """Réintègre immédiatement toutes les clés API ElevenLabs"""
+    await elevenlabs_keys.reset()
+    spawn(elevenlabs_keys.refresh_all())
     
-    current_elevenlabs_key_index = 0
-    elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEYS[0])
-    
-    await ctx.send(f"🔄 Clés ElevenLabs réinitialisées ! Utilisation de la clé 1/{len(ELEVENLABS_API_KEYS)}")
+    await ctx.send(f"🔄 Clés ElevenLabs réinitialisées ! {len(elevenlabs_keys.keys)} clé(s) disponible(s)")
 
 
 @bot.command(name='refill')
 async def refill_cmd(ctx):
     """Force le remplissage du buffer"""
-    await ctx.send("🔄 Remplissage du buffer en cours...")
-    bot.loop.create_task(refill_buffer())
-    await ctx.send("✅ Tâche de remplissage lancée !")
+    buffer_pipeline.consecutive_failures = 0  # Ignore le backoff en cours
+    signal_refill()
+    await ctx.send("✅ Remplissage du buffer demandé !")
+
+
+@bot.command(name='pool')
+async def pool_status(ctx):
+    """Affiche le statut du pool de connexions vocales"""
+    average = voice_pool.average_connect_time()
+    average_text = f"{average:.2f}s" if average else "inconnue"
+    total = voice_pool.hits + voice_pool.moves + voice_pool.misses
+    hit_rate = (voice_pool.hits + voice_pool.moves) / total * 100 if total else 0
+    
+    await ctx.send(f"""🔌 **Pool de connexions vocales:**
+
+**Connexions ouvertes:** {len(bot.voice_clients)}
+**Réutilisées:** {voice_pool.hits} (+ {voice_pool.moves} déplacées)
+**Nouvelles connexions:** {voice_pool.misses}
+**Taux de réutilisation:** {hit_rate:.0f}%
+**Temps de connexion moyen:** {average_text}
+**Temps économisé:** ~{voice_pool.saved_seconds():.1f}s
+**Fermeture après inactivité:** {voice_pool.idle_timeout:.0f}s""")
 
 
 @bot.command(name='disconnect')
@@ -624,6 +3785,7 @@ async def disconnect(ctx):
     voice_client = discord.utils.get(bot.voice_clients, guild=ctx.guild)
     
     if voice_client and voice_client.is_connected():
+        voice_pool.acquire(ctx.guild.id)  # Annule la déconnexion programmée
         await voice_client.disconnect()
         await ctx.send("👋 Déconnecté du canal vocal")
     else:
@@ -649,6 +3811,7 @@ async def speed(ctx, new_speed: float = None):
         return
     
     TTS_SPEED = new_speed
+    on_tts_settings_changed()
     await ctx.send(f"✅ Vitesse définie à: **{TTS_SPEED}x**")
 
 @bot.command(name='voice')
@@ -676,6 +3839,7 @@ async def voice(ctx, voice_name: str = None):
     
     if voice_name in VOICES_PRESETS:
         TTS_VOICE_ID = VOICES_PRESETS[voice_name]
+        on_tts_settings_changed()
         await ctx.send(f"✅ Voix changée à: **{voice_name}**")
     else:
         voice_list = ", ".join(VOICES_PRESETS.keys())
@@ -696,6 +3860,7 @@ async def voice_custom(ctx, voice_id: str):
         return
     
     TTS_VOICE_ID = voice_id
+    on_tts_settings_changed()
     await ctx.send(f"✅ Voix TTS définie à l'ID: `{voice_id}`")
 
 @bot.command(name='similarity-boost')
@@ -720,6 +3885,7 @@ async def similarity_boost(ctx, new_similarity_boost: float = None):
         return
     
     TTS_SIMILARITY_BOOST = new_similarity_boost
+    on_tts_settings_changed()
     await ctx.send(f"✅ Similarity Boost défini à: **{TTS_SIMILARITY_BOOST}**")
 
 @bot.command(name='stability')
@@ -745,6 +3911,7 @@ async def stability(ctx, new_stability: float = None):
         return
     
     TTS_STABILITY = new_stability
+    on_tts_settings_changed()
     await ctx.send(f"✅ Stabilité définie à: **{TTS_STABILITY}**")
 
 @bot.command(name='style')
@@ -770,6 +3937,7 @@ async def style(ctx, new_style: float = None):
         return
     
     TTS_STYLE = new_style
+    on_tts_settings_changed()
     await ctx.send(f"✅ Style défini à: **{TTS_STYLE}**")
 
 @bot.command(name='speaker-boost')
@@ -793,9 +3961,11 @@ async def speaker_boost(ctx, enable: str = None):
     
     if enable_lower in ["on", "true", "1", "yes", "oui"]:
         TTS_USE_SPEAKER_BOOST = True
+        on_tts_settings_changed()
         await ctx.send(f"✅ Speaker boost **activé**")
     elif enable_lower in ["off", "false", "0", "no", "non"]:
         TTS_USE_SPEAKER_BOOST = False
+        on_tts_settings_changed()
         await ctx.send(f"✅ Speaker boost **désactivé**")
     else:
         await ctx.send(f"❌ Valeur invalide: `{enable}`\n\nUtilise: `on` ou `off`")
@@ -871,9 +4041,14 @@ async def tts_settings(ctx):
 `!chaos` - Génère un texte absurde et le lit à voix haute
 `!buffer` - Affiche le statut du buffer de prompts
 `!keys` - Affiche le statut des clés API ElevenLabs
-`!reset-keys` - Réinitialise les clés API à la première
+`!reset-keys` - Réintègre immédiatement toutes les clés API
 `!refill` - Force le remplissage du buffer
 `!prompt` - Affiche le dernier prompt envoyé à Gemini
+`!cache` - Affiche le statut du cache TTS
+`!stats` - Affiche les latences par étape (p50/p95/p99)
+`!queue` - Affiche la file des `!chaos` du serveur et ta position
+`!lag` - Affiche le retard de la boucle et les appels bloquants (`!lag dump` pour les piles)
+`!pool` - Affiche le statut des connexions vocales gardées ouvertes
 `!disconnect` - Déconnecte le bot du canal vocal
 
 **Exemples:**
@@ -889,5 +4064,33 @@ async def tts_settings(ctx):
 """
     await ctx.send(help_text)
 
-# Lancer le bot
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+
+async def run_worker():
+    """Processus de génération seul (CHAOS_ROLE=worker) : Gemini, ElevenLabs et encodage
+    tournent ici, loin de la boucle qui tient la gateway. Les entrées terminées passent
+    par le store partagé ; les processus gateway ne font que dispatcher et jouer."""
+    loop = asyncio.get_running_loop()
+    print(f"🏭 Worker de génération {shared_coordinator.owner} (store: {SHARED_STORE_PATH})")
+    loop_watchdog.start()
+    try:
+        await shared_coordinator.start()
+        await asyncio.gather(
+            loop.run_in_executor(None, chaos_history.load),
+            load_spool(),
+            elevenlabs_keys.refresh_all(),
+            providers.warmup(),
+            return_exceptions=True,
+        )
+        await refresh_stale_entries()
+        await refill_supervisor()
+    finally:
+        await shared_coordinator.close()
+        await providers.close()
+
+
+# Lancer le bot (pas à l'import : bench.py importe ce module)
+if __name__ == "__main__":
+    if CHAOS_ROLE == "worker":
+        asyncio.run(run_worker())
+    else:
+        bot.run(DISCORD_TOKEN)
\ No newline at end of file